@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro benchmarks of the hot paths;  each module can be run from the root
+of the repository, e.g. ``python -m benchmarks.regions``."""
+
+import timeit
+
+
+def best_of(function, number, repeat=5):
+    """Returns the best time, in seconds, a call to ``function`` took, out of
+    ``repeat`` runs of ``number`` calls each."""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
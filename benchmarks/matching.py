@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Matches 10k passengers with 2k drivers spread over a 60 x 60 Km area,
+and compares ``match`` with ranking, for each driver, all the passengers;
+the latter is only run for the first ``BASELINE_DRIVERS`` drivers, and its
+time extrapolated."""
+
+import random
+import time
+from collections import namedtuple
+from math import cos
+from math import radians
+
+from strappon.pubsub import KM_PER_DEG_LAT
+from strappon.pubsub.distances import distances_from
+from strappon.pubsub.matching import match
+
+
+PASSENGERS = 10000
+DRIVERS = 2000
+BASELINE_DRIVERS = 200
+AREA_KM = 60.0
+MAX_KM = 2.0
+FAN_OUT = 5
+
+Passenger = namedtuple('Passenger',
+                       'id origin_latitude origin_longitude seats'.split())
+Position = namedtuple('Position', 'latitude longitude'.split())
+User = namedtuple('User', 'position')
+Driver = namedtuple('Driver', 'id user')
+
+
+def random_point(latitude, longitude):
+    dlat = AREA_KM / KM_PER_DEG_LAT
+    dlon = AREA_KM / (KM_PER_DEG_LAT * cos(radians(latitude)))
+    return (latitude + random.uniform(0, dlat),
+            longitude + random.uniform(0, dlon))
+
+
+def rank_all(passengers, drivers):
+    candidates = []
+    for d in drivers:
+        position = d.user.position
+        distances = distances_from(position.latitude, position.longitude,
+                                   [p.origin_latitude for p in passengers],
+                                   [p.origin_longitude for p in passengers])
+        ranked = sorted((dist, -p.seats, i)
+                        for (i, (p, dist)) in enumerate(zip(passengers,
+                                                            distances))
+                        if dist <= MAX_KM)
+        candidates.extend((passengers[i].id, d.id, dist)
+                          for (dist, _, i) in ranked[:FAN_OUT])
+    return candidates
+
+
+def main():
+    random.seed(4)
+    passengers = [Passenger(i, *(random_point(45.0, 9.0) +
+                                 (random.randint(1, 4),)))
+                  for i in xrange(PASSENGERS)]
+    drivers = [Driver(i, User(Position(*random_point(45.0, 9.0))))
+               for i in xrange(DRIVERS)]
+
+    started = time.time()
+    candidates = match(passengers, drivers, MAX_KM, FAN_OUT)
+    elapsed = time.time() - started
+
+    sample = drivers[:BASELINE_DRIVERS]
+    started = time.time()
+    expected = rank_all(passengers, sample)
+    baseline = (time.time() - started) * DRIVERS / BASELINE_DRIVERS
+    sampled = set(d.id for d in sample)
+    assert sorted(expected) == sorted((c.passenger.id, c.driver.id,
+                                       c.distance)
+                                      for c in candidates
+                                      if c.driver.id in sampled)
+
+    print '%d passengers x %d drivers, %.0f Km radius, fan-out %d' % (
+        PASSENGERS, DRIVERS, MAX_KM, FAN_OUT)
+    print 'match:    %.2fs (%d candidates)' % (elapsed, len(candidates))
+    print 'rank all: %.2fs (extrapolated from %d drivers)' % (
+        baseline, BASELINE_DRIVERS)
+
+
+if __name__ == '__main__':
+    main()
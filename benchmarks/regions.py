@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares the linear scan of ``closest_region`` with ``RegionsIndex``, on
+random regions and points laid over an Italy-sized box."""
+
+import random
+
+from benchmarks import best_of
+from strappon.pubsub.positions import RegionsIndex
+from strappon.pubsub.positions import closest_region
+
+
+POINTS = 2000
+
+
+def random_regions(n):
+    return [dict(name='r%d' % i,
+                 center=dict(lat=random.uniform(35, 47),
+                             lon=random.uniform(6, 18)),
+                 radius=random.uniform(5, 60))
+            for i in xrange(n)]
+
+
+def main():
+    random.seed(1)
+    print '%8s %12s %12s' % ('regions', 'linear', 'index')
+    for n in (10, 100, 1000):
+        regions = random_regions(n)
+        index = RegionsIndex(regions)
+        points = [(random.uniform(35, 47), random.uniform(6, 18))
+                  for _ in xrange(POINTS)]
+        assert all(index.closest(lat, lon) ==
+                   closest_region(regions, lat, lon)
+                   for (lat, lon) in points)
+        linear = best_of(lambda: [closest_region(regions, lat, lon)
+                                  for (lat, lon) in points], 3)
+        indexed = best_of(lambda: [index.closest(lat, lon)
+                                   for (lat, lon) in points], 3)
+        print '%8d %10.2fus %10.2fus' % (n, linear / POINTS * 1e6,
+                                         indexed / POINTS * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares counting the rides given during the eligibility window of each
+early-bird perk one window at a time, with ``rides_given_many``, on 5000
+drivers with up to 12 drive requests each, stored in an in-memory SQLite
+database;  both are checked against counts computed in Python."""
+
+import random
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from strappon.models import Base
+from strappon.models import DriveRequest
+from strappon.models import Driver
+from strappon.models import Passenger
+from strappon.models import User
+from strappon.repositories.drive_requests import DriveRequestsRepository
+from tests import setup_database
+
+
+USERS = 5000
+START = datetime(2015, 1, 1)
+
+
+def populate():
+    """Inserts the users, their drive requests, and returns the windows
+    along with the expected number of rides given during each of them."""
+    connection = Base.session.connection()
+    connection.execute(User.__table__.insert(),
+                       [dict(id=u'u%d' % i, name=u'name', locale=u'en')
+                        for i in xrange(USERS)])
+    connection.execute(Driver.__table__.insert(),
+                       [dict(id=u'd%d' % i, user_id=u'u%d' % i)
+                        for i in xrange(USERS)])
+    connection.execute(Passenger.__table__.insert(),
+                       [dict(id=u'p', user_id=u'u0', distance=1.0)])
+    requests = [dict(id=u'r%d_%d' % (i, j), driver_id=u'd%d' % i,
+                     passenger_id=u'p', active=False,
+                     accepted=random.random() < .8,
+                     cancelled=random.random() < .1,
+                     created=START + timedelta(hours=random.randint(0,
+                                                                    24 * 60)))
+                for i in xrange(USERS)
+                for j in xrange(random.randint(0, 12))]
+    connection.execute(DriveRequest.__table__.insert(), requests)
+    Base.session.commit()
+
+    windows = []
+    for i in xrange(USERS):
+        start = START + timedelta(days=random.randint(0, 30))
+        windows.append((u'u%d' % i, start, start + timedelta(days=14)))
+    given = dict(((u'u' + r['driver_id'][1:], r['created']), 0)
+                 for r in requests)
+    for r in requests:
+        if r['accepted'] and not r['cancelled']:
+            given[(u'u' + r['driver_id'][1:], r['created'])] += 1
+    expected = [sum(n for ((u, created), n) in given.iteritems()
+                    if u == user_id and start <= created <= end)
+                for (user_id, start, end) in windows]
+    return (windows, expected)
+
+
+def timed(statements, function, *args):
+    del statements[:]
+    start = time.time()
+    result = function(*args)
+    return (result, len(statements), time.time() - start)
+
+
+def main():
+    random.seed(5)
+    statements = setup_database()
+    (windows, expected) = populate()
+    (one_by_one, queries, elapsed) = timed(
+        statements,
+        lambda: [DriveRequestsRepository.rides_given(*w) for w in windows])
+    assert one_by_one == expected
+    print 'one by one: %d statements, %.2fs' % (queries, elapsed)
+    (batched, queries, elapsed) = timed(
+        statements, DriveRequestsRepository.rides_given_many, windows)
+    assert batched == expected
+    print 'rides_given_many: %d statements, %.2fs' % (queries, elapsed)
+
+
+if __name__ == '__main__':
+    main()
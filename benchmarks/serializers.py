@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares the compiled serializers with the hand written ones they
+replaced (copied below), on lists of 200 random drive requests and
+passengers;  the JSON outputs of the two are checked to be identical
+first."""
+
+import json
+import random
+from datetime import datetime
+from datetime import timedelta
+
+from benchmarks import best_of
+from strappon.pubsub import drive_requests
+from strappon.pubsub import drivers
+from strappon.pubsub import passengers
+from strappon.pubsub import serialize_date
+from strappon.pubsub import users
+from strappon.pubsub.drive_requests import response_time
+
+
+ITEMS = 200
+SAMPLES = 3000
+
+
+def old_user(user):
+    if user is None:
+        return None
+    data = dict(id=user.id, name=user.name, avatar=user.avatar,
+                locale=user.locale)
+    if hasattr(user, 'stars'):
+        data.update(stars=user.stars)
+    if hasattr(user, 'received_rates'):
+        data.update(received_rates=user.received_rates)
+    return data
+
+
+def old_user_with_region(user):
+    if user is None:
+        return None
+    data = old_user(user)
+    if user.position is not None:
+        data.update(region=user.position.region)
+    return data
+
+
+def old_user_with_latlon(user):
+    if user is None:
+        return None
+    data = old_user(user)
+    if user.position is not None:
+        data.update(latitude=user.position.latitude,
+                    longitude=user.position.longitude)
+    return data
+
+
+def old_passenger(passenger):
+    if passenger is None:
+        return None
+    data = dict(id=passenger.id,
+                origin=passenger.origin,
+                origin_latitude=passenger.origin_latitude,
+                origin_longitude=passenger.origin_longitude,
+                destination=passenger.destination,
+                destination_latitude=passenger.destination_latitude,
+                destination_longitude=passenger.destination_longitude,
+                distance=passenger.distance,
+                seats=passenger.seats,
+                pickup_time=serialize_date(passenger.pickup_time_new),
+                matched=passenger.matched)
+    if hasattr(passenger, 'reimbursement'):
+        data.update(reimbursement=passenger.reimbursement)
+    return data
+
+
+def old_passenger_with_user(passenger):
+    data = old_passenger(passenger)
+    data.update(user=old_user(passenger.user))
+    return data
+
+
+def old_passenger_with_region(passenger):
+    data = old_passenger(passenger)
+    data.update(user=old_user_with_region(passenger.user))
+    return data
+
+
+def old_driver(driver):
+    if driver is None:
+        return None
+    return dict(id=driver.id, car_make=driver.car_make,
+                car_model=driver.car_model, car_color=driver.car_color,
+                license_plate=driver.license_plate,
+                telephone=driver.telephone, hidden=driver.hidden)
+
+
+def old_driver_with_user(driver):
+    data = old_driver(driver)
+    data.update(user=old_user(driver.user))
+    return data
+
+
+def old_driver_with_latlon(driver):
+    data = old_driver(driver)
+    data.update(user=old_user_with_latlon(driver.user))
+    return data
+
+
+def old_drive_request(request):
+    if request is None:
+        return None
+    return dict(id=request.id, accepted=request.accepted,
+                offered_pickup_time=serialize_date(request.
+                                                   offered_pickup_time),
+                response_time=response_time(request.created,
+                                            request.offered_pickup_time),
+                created=serialize_date(request.created))
+
+
+def old_drive_request_with_users(request):
+    # The modules used to be imported on every call
+    from strappon.pubsub.drivers import serialize
+    from strappon.pubsub.passengers import serialize
+    from strappon.pubsub.users import serialize
+    data = old_drive_request(request)
+    data.update(passenger=old_passenger(request.passenger))
+    data['passenger'].update(user=old_user(request.passenger.user))
+    data.update(driver=old_driver(request.driver))
+    data['driver'].update(user=old_user(request.driver.user))
+    return data
+
+
+class Fake(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def random_string():
+    return random.choice([None, u'x', u'\xe8',
+                          u'%d' % random.randint(0, 1000000)])
+
+
+def random_date():
+    return datetime(2014, 1, 1) + timedelta(seconds=random.randint(0, 1e8))
+
+
+def random_user():
+    position = Fake(region=random_string(), latitude=random.random(),
+                    longitude=random.random())
+    kwargs = dict(id=random_string(), name=random_string(),
+                  avatar=random_string(), locale=random_string(),
+                  position=random.choice([None, position]))
+    if random.random() < .5:
+        kwargs.update(stars=random.random())
+    if random.random() < .5:
+        kwargs.update(received_rates=random.randint(0, 9))
+    return Fake(**kwargs)
+
+
+def random_passenger():
+    kwargs = dict(id=random_string(), origin=random_string(),
+                  origin_latitude=random.random(),
+                  origin_longitude=random.random(),
+                  destination=random_string(),
+                  destination_latitude=random.random(),
+                  destination_longitude=random.random(),
+                  distance=random.random(), seats=random.randint(1, 4),
+                  pickup_time_new=random.choice([None, random_date()]),
+                  matched=random.random() < .5, user=random_user())
+    if random.random() < .5:
+        kwargs.update(reimbursement=random.random())
+    return Fake(**kwargs)
+
+
+def random_driver():
+    return Fake(id=random_string(), car_make=random_string(),
+                car_model=random_string(), car_color=random_string(),
+                license_plate=random_string(), telephone=random_string(),
+                hidden=random.random() < .5, user=random_user())
+
+
+def random_drive_request():
+    created = random_date()
+    offered = created + timedelta(minutes=random.randint(-10, 100))
+    return Fake(id=random_string(), accepted=random.random() < .5,
+                created=created,
+                offered_pickup_time=random.choice([None, offered]),
+                passenger=random_passenger(), driver=random_driver())
+
+
+PAIRS = [(old_user, users.serialize, random_user),
+         (old_user_with_region, users.serialize_with_region, random_user),
+         (old_user_with_latlon, users.serialize_with_latlon, random_user),
+         (old_passenger, passengers.serialize, random_passenger),
+         (old_passenger_with_user, passengers._serialize, random_passenger),
+         (old_passenger_with_region, passengers._serialize_with_region,
+          random_passenger),
+         (old_driver, drivers.serialize, random_driver),
+         (old_driver_with_user, drivers._serialize, random_driver),
+         (old_driver_with_latlon, drivers._serialize_with_latlon,
+          random_driver),
+         (old_drive_request, drive_requests.serialize, random_drive_request),
+         (old_drive_request_with_users, drive_requests._serialize,
+          random_drive_request)]
+
+
+def main():
+    random.seed(3)
+    for (old, new, factory) in PAIRS:
+        for _ in xrange(SAMPLES):
+            item = factory()
+            assert json.dumps(old(item)) == json.dumps(new(item)), old
+    for (name, old, new, factory) in [
+            ('drive requests', old_drive_request_with_users,
+             drive_requests._serialize, random_drive_request),
+            ('passengers', old_passenger_with_user, passengers._serialize,
+             random_passenger)]:
+        items = [factory() for _ in xrange(ITEMS)]
+        before = best_of(lambda: [old(i) for i in items], 200)
+        after = best_of(lambda: [new(i) for i in items], 200)
+        print '%d %s: %.3fms -> %.3fms' % (ITEMS, name, before * 1e3,
+                                            after * 1e3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares adding one ``Payment`` per settlement through the ORM with
+``PaymentsRepository.add_many``, on an in-memory SQLite database."""
+
+import time
+
+from strappon.models import Base
+from strappon.models import Payment
+from strappon.repositories.payments import PaymentsRepository
+from strappon.repositories.payments import Settlement
+from tests import setup_database
+
+
+SETTLEMENTS = 100000
+USERS = 50
+
+
+def settlements(n):
+    return [Settlement('dr%d' % i,
+                       None if i % 2 else 'u%d' % (i % USERS),
+                       'u%d' % (i % USERS) if i % 2 else None,
+                       i % 7,
+                       None if i % 3 else 'pc')
+            for i in xrange(n)]
+
+
+def balances():
+    return dict((user_id, PaymentsRepository.detailed_balance(user_id))
+                for user_id in ('u%d' % i for i in xrange(USERS)))
+
+
+def add_one_by_one(settlements):
+    for s in settlements:
+        bonus = s.promo_code_id is not None
+        Base.session.add(
+            PaymentsRepository.add(s.drive_request_id, s.payer_user_id,
+                                   s.payee_user_id,
+                                   0 if bonus else s.credits,
+                                   s.credits if bonus else 0,
+                                   s.promo_code_id))
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    Base.session.commit()
+    return time.time() - start
+
+
+def main():
+    setup_database()
+    rows = settlements(SETTLEMENTS)
+    orm = timed(add_one_by_one, rows)
+    expected = balances()
+    Base.session.execute(Payment.__table__.delete())
+    Base.session.commit()
+    bulk = timed(PaymentsRepository.add_many, rows)
+    assert Base.session.query(Payment).count() == SETTLEMENTS
+    assert balances() == expected
+    print 'orm %.2fs (%d/s)  add_many %.2fs (%d/s)' % (
+        orm, SETTLEMENTS / orm, bulk, SETTLEMENTS / bulk)
+
+
+if __name__ == '__main__':
+    main()
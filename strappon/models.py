@@ -8,6 +8,7 @@ from weblib.db import Column
 from weblib.db import DateTime
 from weblib.db import Float
 from weblib.db import ForeignKey
+from weblib.db import Index
 from weblib.db import Integer
 from weblib.db import ReprMixin
 from weblib.db import String
@@ -174,6 +175,50 @@ class Rate(Base, ReprMixin):
                      onupdate=datetime.utcnow)
 
 
+class UserRatingSummary(Base, ReprMixin):
+    __tablename__ = 'user_rating_summary'
+
+    user_id = Column(String, ForeignKey('user.id'), primary_key=True)
+    stars_sum = Column(Integer, nullable=False, default=0)
+    received_rates = Column(Integer, nullable=False, default=0)
+    stars_1 = Column(Integer, nullable=False, default=0)
+    stars_2 = Column(Integer, nullable=False, default=0)
+    stars_3 = Column(Integer, nullable=False, default=0)
+    stars_4 = Column(Integer, nullable=False, default=0)
+    stars_5 = Column(Integer, nullable=False, default=0)
+    created = Column(DateTime, default=datetime.utcnow)
+    updated = Column(DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow)
+
+
+class PendingRating(Base, ReprMixin):
+    __tablename__ = 'pending_rating'
+    __table_args__ = (Index('ix_pending_rating_user_id_driver_id',
+                            'user_id', 'driver_id'),
+                      Index('ix_pending_rating_user_id_passenger_id',
+                            'user_id', 'passenger_id'))
+
+    drive_request_id = Column(String, ForeignKey('drive_request.id'),
+                              primary_key=True)
+    user_id = Column(String, ForeignKey('user.id'), primary_key=True)
+    driver_id = Column(String, ForeignKey('driver.id'), nullable=False)
+    passenger_id = Column(String, ForeignKey('passenger.id'), nullable=False)
+    created = Column(DateTime, default=datetime.utcnow)
+
+
+class UserRideStats(Base, ReprMixin):
+    __tablename__ = 'user_ride_stats'
+
+    user_id = Column(String, ForeignKey('user.id'), primary_key=True)
+    rides_driver = Column(Integer, nullable=False, default=0)
+    rides_passenger = Column(Integer, nullable=False, default=0)
+    distance_driver = Column(Float, nullable=False, default=0.0)
+    distance_passenger = Column(Float, nullable=False, default=0.0)
+    created = Column(DateTime, default=datetime.utcnow)
+    updated = Column(DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow)
+
+
 class DriverPerk(Base, ReprMixin):
     __tablename__ = 'driver_perk'
 
@@ -191,6 +236,9 @@ class DriverPerk(Base, ReprMixin):
 
 class EligibleDriverPerk(Base, ReprMixin):
     __tablename__ = 'eligible_driver_perk'
+    __table_args__ = (
+        Index('ix_eligible_driver_perk_user_id_deleted_valid_until',
+              'user_id', 'deleted', 'valid_until'),)
 
     id = Column(String, default=uuid, primary_key=True)
     created = Column(DateTime, default=datetime.utcnow)
@@ -207,6 +255,9 @@ class EligibleDriverPerk(Base, ReprMixin):
 
 class ActiveDriverPerk(Base, ReprMixin):
     __tablename__ = 'active_driver_perk'
+    __table_args__ = (
+        Index('ix_active_driver_perk_user_id_deleted_valid_until',
+              'user_id', 'deleted', 'valid_until'),)
 
     id = Column(String, default=uuid, primary_key=True)
     created = Column(DateTime, default=datetime.utcnow)
@@ -238,6 +289,9 @@ class PassengerPerk(Base, ReprMixin):
 
 class EligiblePassengerPerk(Base, ReprMixin):
     __tablename__ = 'eligible_passenger_perk'
+    __table_args__ = (
+        Index('ix_eligible_passenger_perk_user_id_deleted_valid_until',
+              'user_id', 'deleted', 'valid_until'),)
 
     id = Column(String, default=uuid, primary_key=True)
     created = Column(DateTime, default=datetime.utcnow)
@@ -253,6 +307,9 @@ class EligiblePassengerPerk(Base, ReprMixin):
 
 class ActivePassengerPerk(Base, ReprMixin):
     __tablename__ = 'active_passenger_perk'
+    __table_args__ = (
+        Index('ix_active_passenger_perk_user_id_deleted_valid_until',
+              'user_id', 'deleted', 'valid_until'),)
 
     id = Column(String, default=uuid, primary_key=True)
     created = Column(DateTime, default=datetime.utcnow)
@@ -266,6 +323,18 @@ class ActivePassengerPerk(Base, ReprMixin):
     perk = relationship('PassengerPerk', uselist=False, cascade='expunge')
 
 
+class PerkCampaignCheckpoint(Base, ReprMixin):
+    __tablename__ = 'perk_campaign_checkpoint'
+
+    campaign = Column(String, primary_key=True)
+    created = Column(DateTime, default=datetime.utcnow)
+    updated = Column(DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow)
+    token = Column(String, nullable=True)
+    completed = Column(Boolean, default=False, nullable=False)
+    activated = Column(Integer, default=0, nullable=False)
+
+
 class Payment(Base, ReprMixin):
     __tablename__ = 'payment'
 
@@ -282,6 +351,19 @@ class Payment(Base, ReprMixin):
     promo_code_id = Column(String, ForeignKey('promo_code.id'), nullable=True)
 
 
+class BalanceCheckpoint(Base, ReprMixin):
+    __tablename__ = 'balance_checkpoint'
+
+    id = Column(String, default=uuid, primary_key=True)
+    created = Column(DateTime, default=datetime.utcnow)
+    updated = Column(DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow)
+    user_id = Column(String, ForeignKey('user.id'), nullable=False)
+    promo_code_id = Column(String, ForeignKey('promo_code.id'), nullable=True)
+    credits = Column(Integer, nullable=False)
+    until = Column(DateTime, nullable=False)
+
+
 class Trace(Base, ReprMixin):
     __tablename__ = 'trace'
 
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from datetime import date
+from datetime import datetime
 from math import pi
 from math import sqrt
 from math import radians
@@ -76,7 +78,42 @@ class DistanceCalculator(Publisher):
         self.publish('distance_calculated', distance(lat1, lon1, lat2, lon2))
 
 
+DATE_FORMAT = '%04d-%02d-%02dT%02d:%02d:%02dZ'
+STRFTIME_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+SERIALIZED_DATES_MAX = 10000
+
+_serialized_dates = {}
+
+
+def _format_date(value):
+    if isinstance(value, datetime):
+        return DATE_FORMAT % (value.year, value.month, value.day,
+                              value.hour, value.minute, value.second)
+    if isinstance(value, date):
+        return DATE_FORMAT % (value.year, value.month, value.day, 0, 0, 0)
+    # e.g. times
+    return value.strftime(STRFTIME_DATE_FORMAT)
+
+
 def serialize_date(date):
+    """Formats ``date`` as '%Y-%m-%dT%H:%M:%SZ';  dates and datetimes do not
+    go through ``strftime``, other values (e.g. times) do.
+
+    Naive datetimes, i.e. the ones we read from the database, are memoized
+    by second, so that the timestamps repeated across a batch of serialized
+    objects get formatted once;  the cache is dropped as soon as it holds
+    ``SERIALIZED_DATES_MAX`` entries."""
     if date is None:
         return None
-    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if type(date) is not datetime or date.tzinfo is not None:
+        return _format_date(date)
+    serialized = _serialized_dates.get(date)
+    if serialized is None:
+        second = date.replace(microsecond=0)
+        serialized = _serialized_dates.get(second)
+        if serialized is None:
+            if len(_serialized_dates) >= SERIALIZED_DATES_MAX:
+                _serialized_dates.clear()
+            serialized = _serialized_dates[second] = _format_date(date)
+        _serialized_dates[date] = serialized
+    return serialized
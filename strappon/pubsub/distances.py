@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from itertools import izip
+from math import asin
+from math import cos
+from math import radians
+from math import sin
+from math import sqrt
+
+from weblib.pubsub import Publisher
+
+from strappon.pubsub import EARTH_RADIUS
+from strappon.pubsub import KM_PER_DEG_LAT
+
+
+def equirectangular(lat, lon, latitudes, longitudes):
+    """Same approximation of ``strappon.pubsub.distance``, with the scale
+    factor of the longitude computed once for the given origin."""
+    km_per_deg_lon = KM_PER_DEG_LAT * cos(radians(lat))
+    return [sqrt((KM_PER_DEG_LAT * (lat - lat2)) ** 2 +
+                 (km_per_deg_lon * (lon - lon2)) ** 2)
+            for (lat2, lon2) in izip(latitudes, longitudes)]
+
+
+def haversine(lat, lon, latitudes, longitudes):
+    rlat = radians(lat)
+    rlon = radians(lon)
+    cos_rlat = cos(rlat)
+    distances = []
+    for (lat2, lon2) in izip(latitudes, longitudes):
+        rlat2 = radians(lat2)
+        a = (sin((rlat2 - rlat) / 2) ** 2 +
+             cos_rlat * cos(rlat2) * sin((radians(lon2) - rlon) / 2) ** 2)
+        distances.append(2 * EARTH_RADIUS * asin(sqrt(min(1.0, a))))
+    return distances
+
+
+def distances_from(lat, lon, latitudes, longitudes, kernel=equirectangular):
+    """One-to-many distances: returns the list of distances (in Km) between
+    the point (``lat``, ``lon``) and each of the given points."""
+    return kernel(lat, lon, latitudes, longitudes)
+
+
+def distance_matrix(latitudes1, longitudes1, latitudes2, longitudes2,
+                    kernel=equirectangular):
+    """Many-to-many distances: the i-th row contains the distances between
+    the i-th point of the first set and every point of the second one."""
+    latitudes2 = list(latitudes2)
+    longitudes2 = list(longitudes2)
+    return [kernel(lat, lon, latitudes2, longitudes2)
+            for (lat, lon) in izip(latitudes1, longitudes1)]
+
+
+class MultipleDistancesCalculator(Publisher):
+    def perform(self, lat, lon, latitudes, longitudes):
+        self.publish('distances_calculated',
+                     distances_from(lat, lon, latitudes, longitudes))
@@ -6,6 +6,13 @@ import math
 from weblib.pubsub import Publisher
 
 from strappon.pubsub import serialize_date
+from strappon.pubsub.drivers import DRIVER
+from strappon.pubsub.passengers import PASSENGER
+from strappon.pubsub.pagination import PageGetter
+from strappon.pubsub.serializers import compile_serializer
+from strappon.pubsub.serializers import field
+from strappon.pubsub.serializers import nested
+from strappon.pubsub.users import USER
 
 
 class ActiveDriveRequestsFilterExtractor(Publisher):
@@ -42,6 +49,13 @@ class ActiveDriveRequestsWithDriverIdGetter(Publisher):
                      repository.get_all_active_by_driver(driver_id))
 
 
+class ActiveDriveRequestsWithDriverIdPageGetter(PageGetter):
+    def perform(self, repository, driver_id, limit, token):
+        self.publish_page('drive_requests_page_found',
+                          repository.get_all_active_by_driver_page,
+                          driver_id, limit, token)
+
+
 class ActiveDriveRequestsWithPassengerIdGetter(Publisher):
     def perform(self, repository, passenger_id):
         """Search for all the active drive requests associated with the given
@@ -64,6 +78,21 @@ class ActiveDriveRequestsGetter(Publisher):
         self.publish('drive_requests_found', repository.get_all_active())
 
 
+class ActiveDriveRequestsPageGetter(PageGetter):
+    def perform(self, repository, limit, token):
+        """Search for a page of active drive requests, starting right after
+        the ones already returned together with ``token``.
+
+        When done, a 'drive_requests_page_found' message will be published,
+        together with the page (i.e. the drive requests and the token for the
+        next page);  an 'invalid_page_token' message is published instead if
+        ``token`` could not be decoded.
+        """
+        self.publish_page('drive_requests_page_found',
+                          repository.get_all_active_page,
+                          limit, token)
+
+
 class UnratedDriveRequestsWithDriverIdGetter(Publisher):
     def perform(self, repository, driver_id, user_id):
         self.publish('drive_requests_found',
@@ -71,6 +100,13 @@ class UnratedDriveRequestsWithDriverIdGetter(Publisher):
                                                          user_id))
 
 
+class UnratedDriveRequestsWithDriverIdPageGetter(PageGetter):
+    def perform(self, repository, driver_id, user_id, limit, token):
+        self.publish_page('drive_requests_page_found',
+                          repository.get_unrated_by_driver_id_page,
+                          driver_id, user_id, limit, token)
+
+
 class UnratedDriveRequestsWithPassengerIdGetter(Publisher):
     def perform(self, repository, passenger_id, user_id):
         self.publish('drive_requests_found',
@@ -110,7 +146,17 @@ class DriveRequestWithIdAndDriverIdGetter(Publisher):
 
 
 class DriveRequestCancellor(Publisher):
-    def perform(self, request):
+    def perform(self, request, repository=None):
+        """Cancels the given drive request;  if the drive requests
+        ``repository`` is given, the request is also removed from the ride
+        stats of its driver and passenger users if it was accepted, otherwise
+        ``CancelledRidesRemover`` should be chained.
+
+        When done, a 'drive_request_cancelled' message will be published,
+        together with the cancelled request.
+        """
+        if repository is not None:
+            repository.cancel_all([request.id])
         request.active = False
         request.cancelled = True
         self.publish('drive_request_cancelled', request)
@@ -127,6 +173,55 @@ class DriveRequestCancellorByPassengerId(Publisher):
             self.publish('drive_request_cancelled', request)
 
 
+class PendingRatingsCreator(Publisher):
+    def perform(self, repository, requests):
+        """Queues the given, just completed, drive requests for being rated
+        by their driver and passenger users.
+
+        When done, a 'pending_ratings_created' message will be published,
+        together with the number of queued ratings.
+        """
+        self.publish('pending_ratings_created',
+                     repository.add_pending_ratings([r.id for r in requests]))
+
+
+class PendingRatingsBackfiller(Publisher):
+    def perform(self, repository, chunk_size):
+        """Queues for rating all the completed drive requests which have not
+        been rated yet.
+
+        When done, a 'pending_ratings_backfilled' message will be published,
+        together with the number of queued ratings.
+        """
+        self.publish('pending_ratings_backfilled',
+                     repository.backfill_pending_ratings(chunk_size))
+
+
+class CancelledRidesRemover(Publisher):
+    def perform(self, repository, requests):
+        """Removes the accepted requests among the given, just cancelled,
+        ones from the ride stats of their driver and passenger users.
+
+        When done, a 'cancelled_rides_removed' message will be published,
+        together with the list of requests removed from the stats.
+        """
+        accepted = [r for r in requests if r.accepted]
+        repository.remove_rides([r.id for r in accepted])
+        self.publish('cancelled_rides_removed', accepted)
+
+
+class RideStatsRebuilder(Publisher):
+    def perform(self, repository, chunk_size):
+        """Recompute the per-user ride stats out of the accepted drive
+        requests.
+
+        When done, a 'ride_stats_rebuilt' message will be published, together
+        with the number of rebuilt stats.
+        """
+        self.publish('ride_stats_rebuilt',
+                     repository.rebuild_ride_stats(chunk_size))
+
+
 def response_time(created, offered_pickup_time):
     if offered_pickup_time is None:
         return 0
@@ -135,26 +230,21 @@ def response_time(created, offered_pickup_time):
     return max(0, response_time)
 
 
-def serialize(request):
-    if request is None:
-        return None
-    return dict(id=request.id, accepted=request.accepted,
-                offered_pickup_time=serialize_date(request.offered_pickup_time),
-                response_time=response_time(request.created,
-                                            request.offered_pickup_time),
-                created=serialize_date(request.created))
+DRIVE_REQUEST = [field('id'),
+                 field('accepted'),
+                 field('offered_pickup_time', serialize_date),
+                 field('response_time', response_time,
+                       ['created', 'offered_pickup_time']),
+                 field('created', serialize_date)]
 
 
-def _serialize(request):
-    from strappon.pubsub.drivers import serialize as serialize_driver
-    from strappon.pubsub.passengers import serialize as serialize_passenger
-    from strappon.pubsub.users import serialize as serialize_user
-    d = serialize(request)
-    d.update(passenger=serialize_passenger(request.passenger))
-    d['passenger'].update(user=serialize_user(request.passenger.user))
-    d.update(driver=serialize_driver(request.driver))
-    d['driver'].update(user=serialize_user(request.driver.user))
-    return d
+serialize = compile_serializer('serialize_drive_request', DRIVE_REQUEST)
+_serialize = compile_serializer('serialize_drive_request_with_users',
+                                DRIVE_REQUEST +
+                                [nested('passenger',
+                                        PASSENGER + [nested('user', USER)]),
+                                 nested('driver',
+                                        DRIVER + [nested('user', USER)])])
 
 
 class MultipleDriveRequestsSerializer(Publisher):
@@ -184,16 +274,86 @@ class MultipleDriveRequestsDeactivator(Publisher):
 
 
 class MultipleDriveRequestsCancellor(Publisher):
-    def perform(self, requests):
+    def perform(self, requests, repository=None):
+        """Cancels the given drive requests;  if the drive requests
+        ``repository`` is given, the accepted ones are also removed from the
+        ride stats of their driver and passenger users, otherwise
+        ``CancelledRidesRemover`` should be chained.
+
+        When done, a 'drive_requests_cancelled' message will be published,
+        together with the list of cancelled requests.
+        """
         def cancel(request):
             request.active = False
             request.cancelled = True
             return request
 
+        if repository is not None:
+            repository.cancel_all([r.id for r in requests])
         self.publish('drive_requests_cancelled',
                      [cancel(r) for r in requests])
 
 
+class MultipleDriveRequestIdsDeactivator(Publisher):
+    def perform(self, repository, ids):
+        """Deactivates the active drive requests among the ones identified by
+        ``ids``, without loading them.
+
+        When done, a 'drive_request_ids_hid' message will be published,
+        toghether with the IDs of the deactivated requests.
+        """
+        self.publish('drive_request_ids_hid', repository.deactivate_all(ids))
+
+
+class DriveRequestIdsWithDriverIdDeactivator(Publisher):
+    def perform(self, repository, driver_id):
+        self.publish('drive_request_ids_hid',
+                     repository.deactivate_all_by_driver_id(driver_id))
+
+
+class DriveRequestIdsWithPassengerIdDeactivator(Publisher):
+    def perform(self, repository, passenger_id):
+        self.publish('drive_request_ids_hid',
+                     repository.deactivate_all_by_passenger_id(passenger_id))
+
+
+class MultipleDriveRequestIdsCancellor(Publisher):
+    def perform(self, repository, ids):
+        """Cancels the active drive requests among the ones identified by
+        ``ids``, without loading them.
+
+        When done, a 'drive_request_ids_cancelled' message will be published,
+        toghether with the IDs of the cancelled requests.
+        """
+        self.publish('drive_request_ids_cancelled', repository.cancel_all(ids))
+
+
+class DriveRequestIdsWithDriverIdCancellor(Publisher):
+    def perform(self, repository, driver_id):
+        self.publish('drive_request_ids_cancelled',
+                     repository.cancel_all_by_driver_id(driver_id))
+
+
+class DriveRequestIdsWithPassengerIdCancellor(Publisher):
+    def perform(self, repository, passenger_id):
+        self.publish('drive_request_ids_cancelled',
+                     repository.cancel_all_by_passenger_id(passenger_id))
+
+
+class DriveRequestIdCancellor(Publisher):
+    def perform(self, repository, id):
+        """Cancels the drive request identified by ``id``, if still active.
+
+        On success a 'drive_request_id_cancelled' message with the ID of the
+        request will be published;  on the other hand a
+        'drive_request_not_found' message will be generated.
+        """
+        if repository.cancel_all([id]):
+            self.publish('drive_request_id_cancelled', id)
+        else:
+            self.publish('drive_request_not_found', id)
+
+
 class AcceptedDriveRequestsFilter(Publisher):
     def perform(self, requests):
         """Filter out all the requests with 'accepted' equal to `False`.
@@ -207,42 +367,40 @@ class AcceptedDriveRequestsFilter(Publisher):
 def enrich(request):
     return request
 
-def _enrich(rates_repository, request):
+def _enrich_users(rates_repository, requests):
+    from strappon.pubsub.users import enrich_many as enrich_users
+    enrich_users(rates_repository,
+                 [r.passenger.user for r in requests] +
+                 [r.driver.user for r in requests])
+
+
+def _enrich(request):
     from strappon.pubsub.passengers import enrich as enrich_passenger
     from strappon.pubsub.drivers import enrich as enrich_driver
-    from strappon.pubsub.users import enrich as enrich_user
-    request.passenger.user = enrich_user(rates_repository,
-                                         request.passenger.user)
     request.passenger = enrich_passenger(request.passenger)
-    request.driver.user = enrich_user(rates_repository,
-                                         request.driver.user)
     request.driver = enrich_driver(request.driver)
     return enrich(request)
 
 class DriveRequestsEnricher(Publisher):
     def perform(self, rates_repository, requests):
+        _enrich_users(rates_repository, requests)
         self.publish('drive_requests_enriched',
-                     [_enrich(rates_repository, r) for r in requests])
+                     [_enrich(r) for r in requests])
 
 
-def _enrich_driver_request(rates_repository, fixed_rate, multiplier, request):
-    from strappon.pubsub.passengers import enrich_with_reimbursement as enrich_passenger
+def _enrich_driver_request(request):
     from strappon.pubsub.drivers import enrich as enrich_driver
-    from strappon.pubsub.users import enrich as enrich_user
-    request.passenger.user = enrich_user(rates_repository,
-                                         request.passenger.user)
-    request.passenger = enrich_passenger(fixed_rate, multiplier,
-                                         request.passenger)
-    request.driver.user = enrich_user(rates_repository, request.driver.user)
     request.driver = enrich_driver(request.driver)
     return enrich(request)
 
 
 class DriverDriveRequestsEnricher(Publisher):
     def perform(self, rates_repository, fixed_rate, multiplier, requests):
+        from strappon.pubsub.passengers import enrich_many_with_reimbursement as enrich_passengers
+        _enrich_users(rates_repository, requests)
+        passengers = enrich_passengers(fixed_rate, multiplier,
+                                       [r.passenger for r in requests])
+        for (request, passenger) in zip(requests, passengers):
+            request.passenger = passenger
         self.publish('drive_requests_enriched',
-                     [_enrich_driver_request(rates_repository,
-                                             fixed_rate,
-                                             multiplier,
-                                             r)
-                      for r in requests])
+                     [_enrich_driver_request(r) for r in requests])
@@ -1,8 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from array import array
+from heapq import nsmallest
+from itertools import izip
+from math import cos
+from math import floor
+from math import radians
+
 from weblib.pubsub import Publisher
 
+from strappon.pubsub import KM_PER_DEG_LAT
+from strappon.pubsub.distances import distances_from
+from strappon.pubsub.pagination import PageGetter
+from strappon.pubsub.serializers import compile_serializer
+from strappon.pubsub.serializers import field
+from strappon.pubsub.serializers import nested
+from strappon.pubsub.users import USER
+from strappon.pubsub.users import USER_WITH_LATLON
+
 
 class UnhiddenDriversGetter(Publisher):
     def perform(self, repository):
@@ -14,12 +30,173 @@ class UnhiddenDriversGetter(Publisher):
         self.publish('unhidden_drivers_found', repository.get_all_unhidden())
 
 
+class UnhiddenDriversPageGetter(PageGetter):
+    def perform(self, repository, limit, token):
+        self.publish_page('unhidden_drivers_page_found',
+                          repository.get_all_unhidden_page,
+                          limit, token)
+
+
 class UnhiddenDriversByRegionGetter(Publisher):
     def perform(self, repository, region):
         self.publish('unhidden_drivers_found',
                      repository.get_all_unhidden_by_region(region))
 
 
+class DriversIndex(object):
+    """In-memory nearest-neighbour index over the latest position of the
+    unhidden drivers.
+
+    Coordinates are stored in two ``array('d')`` indexed by slot, while a
+    grid of ``cell_size`` x ``cell_size`` degrees tiles keeps track of the
+    slots falling inside each tile.  Slots freed by ``remove`` are recycled
+    by the following ``update``.
+
+    ``lookup``, if given, is passed the users the index does not know yet
+    (e.g. drivers created, or unhidden, after the index was built), and
+    returns the ID of their unhidden driver, or None.
+    """
+    def __init__(self, cell_size=0.1, lookup=None):
+        self.cell_size = cell_size
+        self.lookup = lookup
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.driver_ids = []
+        self.slots = {}
+        self.free = []
+        self.cells = {}
+        self.drivers = {}
+
+    def _cell(self, latitude, longitude):
+        return (int(floor(latitude / self.cell_size)),
+                int(floor(longitude / self.cell_size)))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, driver_id, user_id, latitude, longitude):
+        self.drivers[user_id] = driver_id
+        self.update(user_id, latitude, longitude)
+
+    def update(self, user_id, latitude, longitude):
+        """Moves the driver associated with ``user_id`` to the given point;
+        users without an unhidden driver (i.e. passengers) are ignored."""
+        driver_id = self.drivers.get(user_id)
+        if driver_id is None and self.lookup is not None:
+            driver_id = self.lookup(user_id)
+        if driver_id is None:
+            return
+        self.drivers[user_id] = driver_id
+        self._remove_position(user_id)
+        if self.free:
+            slot = self.free.pop()
+            self.latitudes[slot] = latitude
+            self.longitudes[slot] = longitude
+            self.driver_ids[slot] = driver_id
+        else:
+            slot = len(self.driver_ids)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+            self.driver_ids.append(driver_id)
+        self.slots[user_id] = slot
+        self.cells.setdefault(self._cell(latitude, longitude), set()).add(slot)
+
+    def remove(self, user_id):
+        """Removes the driver associated with ``user_id`` (e.g. hidden,
+        deactivated or deleted) from the index."""
+        self.drivers.pop(user_id, None)
+        self._remove_position(user_id)
+
+    def _remove_position(self, user_id):
+        slot = self.slots.pop(user_id, None)
+        if slot is None:
+            return
+        key = self._cell(self.latitudes[slot], self.longitudes[slot])
+        self.cells[key].discard(slot)
+        if not self.cells[key]:
+            del self.cells[key]
+        self.driver_ids[slot] = None
+        self.free.append(slot)
+
+    def _candidates(self, latitude, longitude, max_km):
+        if max_km is None:
+            return self.slots.itervalues()
+        dlat = max_km / KM_PER_DEG_LAT
+        km_per_deg_lon = KM_PER_DEG_LAT * cos(radians(latitude))
+        dlon = max_km / km_per_deg_lon if km_per_deg_lon > 0 else 180.0
+        (min_row, min_col) = self._cell(latitude - dlat, longitude - dlon)
+        (max_row, max_col) = self._cell(latitude + dlat, longitude + dlon)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            return (slot for (key, slots) in self.cells.iteritems()
+                    if min_row <= key[0] <= max_row and
+                    min_col <= key[1] <= max_col
+                    for slot in slots)
+        return (slot
+                for row in xrange(min_row, max_row + 1)
+                for col in xrange(min_col, max_col + 1)
+                for slot in self.cells.get((row, col), ()))
+
+    def nearest(self, latitude, longitude, k, max_km=None):
+        """Returns up to ``k`` (driver id, distance) tuples, sorted by
+        distance, of the drivers at most ``max_km`` away from the given
+        point."""
+        slots = list(self._candidates(latitude, longitude, max_km))
+        distances = distances_from(latitude, longitude,
+                                   [self.latitudes[s] for s in slots],
+                                   [self.longitudes[s] for s in slots])
+        found = ((d, self.driver_ids[s]) for (s, d) in izip(slots, distances)
+                 if max_km is None or d <= max_km)
+        return [(driver_id, d) for (d, driver_id) in nsmallest(k, found)]
+
+
+class DriversIndexBuilder(Publisher):
+    def perform(self, repository):
+        """Load the latest position of all the _unhidden_ drivers into a new
+        ``DriversIndex``.
+
+        When done, a 'drivers_index_built' message will be published, followed
+        by the index.
+        """
+        index = DriversIndex(lookup=repository.get_unhidden_id_by_user_id)
+        for (driver_id, user_id, latitude, longitude) in \
+                repository.get_all_unhidden_positions():
+            index.add(driver_id, user_id, latitude, longitude)
+        self.publish('drivers_index_built', index)
+
+
+class DriversIndexPositionUpdater(Publisher):
+    def perform(self, drivers_index, position):
+        drivers_index.update(position.user_id, position.latitude,
+                             position.longitude)
+        self.publish('drivers_index_updated', drivers_index)
+
+
+class DriversIndexPositionsRemover(Publisher):
+    def perform(self, drivers_index, positions):
+        for p in positions:
+            drivers_index.remove(p.user_id)
+        self.publish('drivers_index_updated', drivers_index)
+
+
+class DriversIndexDriversRemover(Publisher):
+    def perform(self, drivers_index, drivers):
+        for d in drivers:
+            drivers_index.remove(d.user_id)
+        self.publish('drivers_index_updated', drivers_index)
+
+
+class NearestDriversGetter(Publisher):
+    def perform(self, drivers_index, latitude, longitude, k, max_km):
+        """Search for the ``k`` drivers closest to the given point, at most
+        ``max_km`` away from it.
+
+        When done, a 'nearest_drivers_found' message will be published,
+        followed by the list of (driver id, distance) tuples.
+        """
+        self.publish('nearest_drivers_found',
+                     drivers_index.nearest(latitude, longitude, k, max_km))
+
+
 class MultipleDriversWithIdGetter(Publisher):
     def perform(self, repository, driver_ids):
         self.publish('drivers_found',
@@ -73,9 +250,17 @@ class DriverCreator(Publisher):
 
 
 class MultipleDriversDeactivator(Publisher):
-    def perform(self, drivers):
+    def perform(self, drivers, drivers_index=None):
+        """Sets the 'active' property of the given drivers to ``False``,
+        removing them from ``drivers_index`` too, if given.
+
+        When done, a 'drivers_hid' message will be published, together with
+        the list of amended drivers.
+        """
         def deactivate(d):
             d.active = False
+            if drivers_index is not None:
+                drivers_index.remove(d.user_id)
             return d
         self.publish('drivers_hid', [deactivate(d) for d in drivers])
 
@@ -124,23 +309,18 @@ class DriverWithoutDriveRequestForPassengerValidator(Publisher):
             self.publish('valid_driver', driver)
 
 
-def serialize(driver):
-    if driver is None:
-        return None
-    return dict(id=driver.id,
-                car_make=driver.car_make,
-                car_model=driver.car_model,
-                car_color=driver.car_color,
-                license_plate=driver.license_plate,
-                telephone=driver.telephone,
-                hidden=driver.hidden)
+DRIVER = [field('id'),
+          field('car_make'),
+          field('car_model'),
+          field('car_color'),
+          field('license_plate'),
+          field('telephone'),
+          field('hidden')]
 
 
-def _serialize(driver):
-    from strappon.pubsub.users import serialize as serialize_user
-    d = serialize(driver)
-    d.update(user=serialize_user(driver.user))
-    return d
+serialize = compile_serializer('serialize_driver', DRIVER)
+_serialize = compile_serializer('serialize_driver_with_user',
+                                DRIVER + [nested('user', USER)])
 
 
 class DriverSerializer(Publisher):
@@ -148,11 +328,9 @@ class DriverSerializer(Publisher):
         self.publish('driver_serialized', _serialize(driver))
 
 
-def _serialize_with_latlon(driver):
-    from strappon.pubsub.users import serialize_with_latlon as serialize_user
-    d = serialize(driver)
-    d.update(user=serialize_user(driver.user))
-    return d
+_serialize_with_latlon = \
+    compile_serializer('serialize_driver_with_latlon',
+                       DRIVER + [nested('user', USER_WITH_LATLON)])
 
 
 class DriverWithLatLonSerializer(Publisher):
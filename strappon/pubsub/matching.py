@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from heapq import nsmallest
+from math import cos
+from math import floor
+from math import radians
+
+from weblib.pubsub import Publisher
+
+from strappon.pubsub import KM_PER_DEG_LAT
+from strappon.pubsub.distances import distances_from
+
+
+Candidate = namedtuple('Candidate', 'passenger driver distance'.split())
+
+
+CELL_SIZE = 0.1  # degrees
+
+
+def _cell(degrees):
+    return int(floor(degrees / CELL_SIZE))
+
+
+def _passengers_grid(passengers, max_seats):
+    grid = {}
+    for p in passengers:
+        if p.origin_latitude is None or p.origin_longitude is None:
+            continue
+        if max_seats is not None and p.seats > max_seats:
+            continue
+        key = (_cell(p.origin_latitude), _cell(p.origin_longitude))
+        grid.setdefault(key, []).append(p)
+    return grid
+
+
+def _nearby(grid, latitude, longitude, max_km):
+    dlat = max_km / KM_PER_DEG_LAT
+    km_per_deg_lon = KM_PER_DEG_LAT * cos(radians(latitude))
+    dlon = max_km / km_per_deg_lon if km_per_deg_lon > 0 else 180.0
+    return [p
+            for row in xrange(_cell(latitude - dlat),
+                              _cell(latitude + dlat) + 1)
+            for col in xrange(_cell(longitude - dlon),
+                              _cell(longitude + dlon) + 1)
+            for p in grid.get((row, col), ())]
+
+
+def match(passengers, drivers, max_km, fan_out, max_seats=None):
+    """Pairs unmatched passengers with unhidden drivers.
+
+    Each driver, located by the latest position of its user, is offered at
+    most ``fan_out`` passengers whose origin is within ``max_km`` from it
+    (closest first, then the ones requesting more seats);  passengers
+    asking for more than ``max_seats`` seats are left out.
+
+    Returns the list of ``Candidate`` tuples sorted by pickup distance.
+    """
+    grid = _passengers_grid(passengers, max_seats)
+    candidates = []
+    for d in drivers:
+        position = d.user.position
+        if position is None:
+            continue
+        nearby = _nearby(grid, position.latitude, position.longitude, max_km)
+        distances = distances_from(position.latitude, position.longitude,
+                                   [p.origin_latitude for p in nearby],
+                                   [p.origin_longitude for p in nearby])
+        best = nsmallest(fan_out,
+                         ((dist, -p.seats, i)
+                          for (i, (p, dist)) in enumerate(zip(nearby,
+                                                              distances))
+                          if dist <= max_km))
+        candidates.extend(Candidate(nearby[i], d, dist)
+                          for (dist, _, i) in best)
+    candidates.sort(key=lambda c: c.distance)
+    return candidates
+
+
+class DriveRequestCandidatesMatcher(Publisher):
+    def perform(self, passengers, drivers, max_km, fan_out, max_seats=None):
+        """Rank the (passenger, driver) pairs of a region by pickup distance,
+        leaving out the passengers asking for more than ``max_seats`` seats.
+
+        ``passengers`` and ``drivers`` are usually the output of
+        ``UnmatchedPassengersByRegionGetter`` and
+        ``UnhiddenDriversByRegionGetter``.  When done, a 'candidates_found'
+        message will be published, followed by the list of candidates.
+        """
+        self.publish('candidates_found',
+                     match(passengers, drivers, max_km, fan_out, max_seats))
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from weblib.pubsub import Publisher
+
+
+class PageGetter(Publisher):
+    def publish_page(self, message, get_page, *args):
+        """Publishes ``message``, followed by the page returned by
+        ``get_page(*args)``, the last argument being the page token;  an
+        'invalid_page_token' message is published instead if the token could
+        not be decoded."""
+        try:
+            page = get_page(*args)
+        except ValueError:
+            self.publish('invalid_page_token', args[-1])
+        else:
+            self.publish(message, page)
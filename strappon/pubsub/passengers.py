@@ -2,6 +2,13 @@
 # -*- coding: utf-8 -*-
 
 from strappon.pubsub import serialize_date
+from strappon.pubsub.pagination import PageGetter
+from strappon.pubsub.serializers import compile_serializer
+from strappon.pubsub.serializers import field
+from strappon.pubsub.serializers import nested
+from strappon.pubsub.serializers import optional
+from strappon.pubsub.users import USER
+from strappon.pubsub.users import USER_WITH_REGION
 from weblib.pubsub import Publisher
 
 
@@ -38,18 +45,49 @@ class UnmatchedPassengersGetter(Publisher):
         self.publish('passengers_found', repository.get_all_unmatched())
 
 
+class UnmatchedPassengersPageGetter(PageGetter):
+    def perform(self, repository, limit, token):
+        self.publish_page('passengers_page_found',
+                          repository.get_all_unmatched_page,
+                          limit, token)
+
+
 class UnmatchedPassengersByRegionGetter(Publisher):
     def perform(self, repository, region):
         self.publish('passengers_found',
                      repository.get_all_unmatched_by_region(region))
 
 
+class UnmatchedPassengersByRegionDeltaGetter(Publisher):
+    def perform(self, repository, region, cursor):
+        """Search for the unmatched passengers of the given region added,
+        changed or gone since ``cursor``.
+
+        When done, a 'passengers_delta_found' message will be published,
+        followed by the delta (updated passengers, removed IDs and the new
+        cursor).
+        """
+        self.publish('passengers_delta_found',
+                     repository.get_unmatched_by_region_since(region, cursor))
+
+
 class ExpiredPassengersGetter(Publisher):
     def perform(self, repository, expire_after):
         self.publish('passengers_found',
                      repository.get_all_expired(expire_after))
 
 
+class ExpiredPassengersDeactivator(Publisher):
+    def perform(self, repository, expire_after):
+        """Hides all the expired passengers, in bulk.
+
+        When done, a 'passengers_expired' message will be published, followed
+        by the list of (id, user_id) tuples of the hidden passengers.
+        """
+        self.publish('passengers_expired',
+                     repository.deactivate_all_expired(expire_after))
+
+
 class ActivePassengersGetter(Publisher):
     def perform(self, repository):
         """Search for all the active passengers around.
@@ -60,6 +98,13 @@ class ActivePassengersGetter(Publisher):
         self.publish('passengers_found', repository.get_all_active())
 
 
+class ActivePassengersPageGetter(PageGetter):
+    def perform(self, repository, limit, token):
+        self.publish_page('passengers_page_found',
+                          repository.get_all_active_page,
+                          limit, token)
+
+
 class ActivePassengerWithIdGetter(Publisher):
     def perform(self, repository, passenger_id):
         passenger = repository.get_active_by_id(passenger_id)
@@ -130,30 +175,23 @@ class PassengerLinkedToDriverWithIdAuthorizer(Publisher):
             self.publish('unauthorized', driver_id, passenger)
 
 
-def serialize(passenger):
-    if passenger is None:
-        return None
-    d = dict(id=passenger.id,
-             origin=passenger.origin,
-             origin_latitude=passenger.origin_latitude,
-             origin_longitude=passenger.origin_longitude,
-             destination=passenger.destination,
-             destination_latitude=passenger.destination_latitude,
-             destination_longitude=passenger.destination_longitude,
-             distance=passenger.distance,
-             seats=passenger.seats,
-             pickup_time=serialize_date(passenger.pickup_time_new),
-             matched=passenger.matched)
-    if hasattr(passenger, 'reimbursement'):
-        d.update(reimbursement=passenger.reimbursement)
-    return d
-
-
-def _serialize(passenger):
-    from strappon.pubsub.users import serialize as serialize_user
-    d = serialize(passenger)
-    d.update(user=serialize_user(passenger.user))
-    return d
+PASSENGER = [field('id'),
+             field('origin'),
+             field('origin_latitude'),
+             field('origin_longitude'),
+             field('destination'),
+             field('destination_latitude'),
+             field('destination_longitude'),
+             field('distance'),
+             field('seats'),
+             field('pickup_time', serialize_date, ['pickup_time_new']),
+             field('matched'),
+             optional('reimbursement')]
+
+
+serialize = compile_serializer('serialize_passenger', PASSENGER)
+_serialize = compile_serializer('serialize_passenger_with_user',
+                                PASSENGER + [nested('user', USER)])
 
 
 class PassengerSerializer(Publisher):
@@ -167,11 +205,9 @@ class PassengerSerializer(Publisher):
         self.publish('passenger_serialized', _serialize(passenger))
 
 
-def _serialize_with_region(passenger):
-    from strappon.pubsub.users import serialize_with_region as serialize_user
-    d = serialize(passenger)
-    d.update(user=serialize_user(passenger.user))
-    return d
+_serialize_with_region = \
+    compile_serializer('serialize_passenger_with_region',
+                       PASSENGER + [nested('user', USER_WITH_REGION)])
 
 
 class PassengerWithRegionSerializer(Publisher):
@@ -252,14 +288,20 @@ def enrich_with_reimbursement(fixed_rate, multiplier, passenger):
     return enrich(passenger)
 
 
-def _enrich(rates_repository, fixed_rate, multiplier, passenger):
-    from strappon.pubsub.users import enrich as enrich_user
-    passenger.user = enrich_user(rates_repository, passenger.user)
-    return enrich_with_reimbursement(fixed_rate, multiplier, passenger)
+def enrich_many_with_reimbursement(fixed_rate, multiplier, passengers):
+    from strappon.pubsub.payments import reimbursements_for
+    reimbursements = reimbursements_for(fixed_rate, multiplier,
+                                        [p.seats for p in passengers],
+                                        [p.distance for p in passengers])
+    for (p, reimbursement) in zip(passengers, reimbursements):
+        p.reimbursement = reimbursement
+    return [enrich(p) for p in passengers]
 
 
 class PassengersEnricher(Publisher):
     def perform(self, rates_repository, fixed_rate, multiplier, passengers):
+        from strappon.pubsub.users import enrich_many as enrich_users
+        enrich_users(rates_repository, [p.user for p in passengers])
         self.publish('passengers_enriched',
-                     [_enrich(rates_repository, fixed_rate, multiplier, p)
-                      for p in passengers])
+                     enrich_many_with_reimbursement(fixed_rate, multiplier,
+                                                    passengers))
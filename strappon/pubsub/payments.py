@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from itertools import izip
 from math import pi
 
 from weblib.pubsub import Publisher
@@ -8,6 +9,20 @@ from weblib.pubsub import Publisher
 
 BASE_COST = 0.30  # € per Km per passengers
 
+# (short, long) ride prices for one passenger, and for more passengers
+SINGLE_SEAT_PRICES = (1.5, 2.5)
+MULTIPLE_SEATS_PRICES = (3, 5)
+
+
+def _prices_for(seats, distances):
+    """Batched version of the price rules shared by ``reimbursement_for`` and
+    ``fare_for``:  the prices of each seat count are looked up once, and
+    each distance is only compared with the short ride threshold."""
+    prices = [SINGLE_SEAT_PRICES if s == 1 else MULTIPLE_SEATS_PRICES
+              for s in seats]
+    return [short if d * 1.5 <= pi else long_
+            for ((short, long_), d) in izip(prices, distances)]
+
 
 def reimbursement_for(fixed_rate, multiplier, seats, distance):
     adjusted_distance = distance * 1.5
@@ -23,6 +38,11 @@ def reimbursement_for(fixed_rate, multiplier, seats, distance):
             return 5
 
 
+def reimbursements_for(fixed_rate, multiplier, seats, distances):
+    """Same as ``reimbursement_for``, for lists of seats and distances."""
+    return _prices_for(seats, distances)
+
+
 class ReimbursementCalculator(Publisher):
     def perform(self, fixed_rate, multiplier, seats, distance):
         self.publish('reimbursement_calculated',
@@ -30,6 +50,13 @@ class ReimbursementCalculator(Publisher):
                                        distance))
 
 
+class MultipleReimbursementsCalculator(Publisher):
+    def perform(self, fixed_rate, multiplier, seats, distances):
+        self.publish('reimbursements_calculated',
+                     reimbursements_for(fixed_rate, multiplier, seats,
+                                        distances))
+
+
 def fare_for(fixed_rate, multiplier, seats, distance):
     adjusted_distance = distance * 1.5
     if adjusted_distance <= pi:
@@ -44,12 +71,23 @@ def fare_for(fixed_rate, multiplier, seats, distance):
             return 5
 
 
+def fares_for(fixed_rate, multiplier, seats, distances):
+    """Same as ``fare_for``, for lists of seats and distances."""
+    return _prices_for(seats, distances)
+
+
 class FareCalculator(Publisher):
     def perform(self, fixed_rate, multiplier, seats, distance):
         self.publish('fare_calculated',
                      fare_for(fixed_rate, multiplier, seats, distance))
 
 
+class MultipleFaresCalculator(Publisher):
+    def perform(self, fixed_rate, multiplier, seats, distances):
+        self.publish('fares_calculated',
+                     fares_for(fixed_rate, multiplier, seats, distances))
+
+
 class ReimbursementCreator(Publisher):
     def perform(self, payments_repository, drive_request_id, driver_user_id,
                 credits_):
@@ -81,6 +119,18 @@ class FareCreator(Publisher):
         self.publish('payments_created', payments)
 
 
+class MultipleSettlementsCreator(Publisher):
+    def perform(self, payments_repository, settlements, batch_size):
+        """Post a batch of reimbursements and fares (i.e. ``Settlement``
+        tuples) with bulk INSERTs instead of one ORM object each.
+
+        When done, a 'settlements_created' message will be published,
+        together with the IDs of the created payments.
+        """
+        self.publish('settlements_created',
+                     payments_repository.add_many(settlements, batch_size))
+
+
 class PaymentForPromoCodeCreator(Publisher):
     def perform(self, payments_repository, user_id, promo_code):
         self.publish('payment_created',
@@ -109,6 +159,34 @@ class CreditsReserver(Publisher):
             self.publish('payments_created', None)
 
 
+class BalanceCheckpointsRoller(Publisher):
+    def perform(self, payments_repository, until, chunk_size):
+        """Move the balance checkpoints of the users forward to ``until``.
+
+        When done, a 'balance_checkpoints_rolled' message will be published,
+        together with the number of users whose checkpoint was rolled.
+        """
+        self.publish('balance_checkpoints_rolled',
+                     payments_repository.roll_checkpoints(until, chunk_size))
+
+
+class BalanceCheckpointsVerifier(Publisher):
+    def perform(self, payments_repository, chunk_size):
+        """Rebuild the checkpointed balances from scratch and compare them
+        with the stored checkpoints.
+
+        A 'balance_checkpoints_consistent' message is published if they all
+        match;  otherwise, a 'balance_checkpoints_inconsistent' message will
+        be sent back to subscribers, followed by the IDs of the users whose
+        checkpoint does not match.
+        """
+        mismatching = payments_repository.verify_checkpoints(chunk_size)
+        if mismatching:
+            self.publish('balance_checkpoints_inconsistent', mismatching)
+        else:
+            self.publish('balance_checkpoints_consistent')
+
+
 def serialize(payment):
     if payment is None:
         return None
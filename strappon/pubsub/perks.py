@@ -6,6 +6,7 @@ from collections import namedtuple
 from weblib.pubsub import Publisher
 
 from strappon.pubsub import serialize_date
+from strappon.pubsub.pagination import PageGetter
 
 
 EnrichedDriverEarlyBirdPerk = namedtuple('EnrichedDriverEarlyBirdPerk',
@@ -18,6 +19,13 @@ class DriverPerksGetter(Publisher):
                      repository.all_driver_perks(limit, offset))
 
 
+class DriverPerksPageGetter(PageGetter):
+    def perform(self, repository, limit, token):
+        self.publish_page('perks_page_found',
+                          repository.all_driver_perks_page,
+                          limit, token)
+
+
 class EligibleDriverPerksWithNameGetter(Publisher):
     def perform(self, repository, perk_name):
         self.publish('perks_found',
@@ -47,13 +55,46 @@ class EligibleDriverPerksActivator(Publisher):
 
 class DriverErlyBirdPerkEnricher(Publisher):
     def perform(self, drive_requests_repository, perks):
+        rides_given = drive_requests_repository.\
+            rides_given_many([(p.user_id, p.created, p.valid_until)
+                              for p in perks])
         self.publish('perks_enriched',
-                     [EnrichedDriverEarlyBirdPerk(p,
-                                                  drive_requests_repository.
-                                                  rides_given(p.user_id,
-                                                              p.created,
-                                                              p.valid_until))
-                      for p in perks])
+                     [EnrichedDriverEarlyBirdPerk(p, r)
+                      for (p, r) in zip(perks, rides_given)])
+
+
+def rides_given_at_least(drive_requests_repository, rides):
+    """Returns a campaign decision function activating the eligible perks
+    whose user gave at least ``rides`` rides while being eligible."""
+    def decide(perks):
+        rides_given = drive_requests_repository.\
+            rides_given_many([(p.user_id, p.created, p.valid_until)
+                              for p in perks])
+        return [p for (p, r) in zip(perks, rides_given) if r >= rides]
+    return decide
+
+
+class DriverPerkCampaignRunner(Publisher):
+    def perform(self, perks_repository, campaign, perk_name, decide,
+                chunk_size):
+        """Activates the eligible driver perks named ``perk_name`` for which
+        ``decide`` says so, one chunk of ``chunk_size`` perks at a time.
+
+        A 'perk_campaign_chunk_run' message is published after each chunk,
+        together with the ``CampaignChunk`` outcome:  subscribers are
+        expected to commit there, so that an interrupted campaign can resume
+        from the last committed chunk.  When done, a
+        'perk_campaign_completed' message will be published, together with
+        the name of the campaign.
+        """
+        while True:
+            chunk = perks_repository.\
+                run_driver_perk_campaign_chunk(campaign, perk_name, decide,
+                                               chunk_size)
+            self.publish('perk_campaign_chunk_run', chunk)
+            if chunk.completed:
+                break
+        self.publish('perk_campaign_completed', campaign)
 
 
 class PassengerPerksGetter(Publisher):
@@ -62,6 +103,13 @@ class PassengerPerksGetter(Publisher):
                      repository.all_passenger_perks(limit, offset))
 
 
+class PassengerPerksPageGetter(PageGetter):
+    def perform(self, repository, limit, token):
+        self.publish_page('perks_page_found',
+                          repository.all_passenger_perks_page,
+                          limit, token)
+
+
 def _serialize_perk(gettext, perk):
     if perk is None:
         return None
@@ -122,6 +170,19 @@ class ActivePassengerPerksGetter(Publisher):
                      perks_repository.active_passenger_perks(user_id))
 
 
+class ExpiredPerksSweeper(Publisher):
+    def perform(self, perks_repository, expired_before, chunk_size):
+        """Soft-deletes the eligible and active perks which expired before
+        ``expired_before``.
+
+        When done, an 'expired_perks_swept' message will be published,
+        together with the number of swept rows per perk table.
+        """
+        self.publish('expired_perks_swept',
+                     perks_repository.sweep_expired_perks(expired_before,
+                                                          chunk_size))
+
+
 class DefaultPerksCreator(Publisher):
     def perform(self, perks_repository, user,
                 eligible_driver_perks, active_driver_perks,
@@ -1,20 +1,88 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from math import cos
+from math import floor
+from math import radians
+
 from weblib.pubsub import Publisher
+from strappon.pubsub import KM_PER_DEG_LAT
 from strappon.pubsub import distance
 
 
-class ClosestRegionGetter(Publisher):
-    def perform(self, served_regions, latitude, longitude):
-        for region in served_regions:
+def closest_region(served_regions, latitude, longitude):
+    for region in served_regions:
+        d = distance(region['center']['lat'], region['center']['lon'],
+                     latitude, longitude)
+        if d < region['radius']:
+            return region['name']
+    return None
+
+
+class RegionsIndex(object):
+    """Grid of ``cell_size`` x ``cell_size`` degrees tiles, each one listing
+    the served regions whose bounding box overlaps it.
+
+    Regions are kept in config order, so that ``closest`` returns the same
+    region the linear scan of ``closest_region`` would.
+    """
+    def __init__(self, served_regions, cell_size=1.0):
+        self.cell_size = cell_size
+        self.regions = []
+        self.cells = {}
+        for (i, region) in enumerate(served_regions):
+            lat = region['center']['lat']
+            lon = region['center']['lon']
+            dlat = region['radius'] / KM_PER_DEG_LAT
+            km_per_deg_lon = KM_PER_DEG_LAT * cos(radians(lat))
+            dlon = (region['radius'] / km_per_deg_lon
+                    if km_per_deg_lon > 0 else 180.0)
+            bbox = (lat - dlat, lat + dlat,
+                    max(lon - dlon, -180.0), min(lon + dlon, 180.0))
+            self.regions.append((region, bbox))
+            for row in xrange(self._cell(bbox[0]), self._cell(bbox[1]) + 1):
+                for col in xrange(self._cell(bbox[2]),
+                                  self._cell(bbox[3]) + 1):
+                    self.cells.setdefault((row, col), []).append(i)
+
+    def _cell(self, degrees):
+        return int(floor(degrees / self.cell_size))
+
+    def closest(self, latitude, longitude):
+        key = (self._cell(latitude), self._cell(longitude))
+        for i in self.cells.get(key, ()):
+            (region, (min_lat, max_lat, min_lon, max_lon)) = self.regions[i]
+            if not (min_lat <= latitude <= max_lat and
+                    min_lon <= longitude <= max_lon):
+                continue
             d = distance(region['center']['lat'], region['center']['lon'],
                          latitude, longitude)
             if d < region['radius']:
-                self.publish('region_found', region['name'])
-                return
+                return region['name']
+        return None
+
+
+class ClosestRegionGetter(Publisher):
+    def perform(self, served_regions, latitude, longitude):
+        """Search for the first of the served regions containing the given
+        point.
+
+        ``served_regions`` can either be the list of regions read from the
+        config, or a ``RegionsIndex`` built once out of it:  the latter only
+        checks the regions whose bounding box contains the point.
+
+        On success a 'region_found' message is published together with the
+        name of the region;  otherwise, a 'region_not_found' message will be
+        sent back to subscribers.
+        """
+        if isinstance(served_regions, RegionsIndex):
+            name = served_regions.closest(latitude, longitude)
         else:
+            name = closest_region(served_regions, latitude, longitude)
+        if name is None:
             self.publish('region_not_found', latitude, longitude)
+        else:
+            self.publish('region_found', name)
 
 
 class PositionsByUserIdGetter(Publisher):
@@ -10,3 +10,30 @@ class RateCreator(Publisher):
         rate = repository.add(drive_request_id, rater_user_id, rated_user_id,
                               rater_is_driver, stars)
         self.publish('rate_created', rate)
+
+
+class RatingSummariesRebuilder(Publisher):
+    def perform(self, repository, chunk_size):
+        """Recompute the per-user rating summaries out of the recorded rates.
+
+        When done, a 'rating_summaries_rebuilt' message will be published,
+        together with the number of rebuilt summaries.
+        """
+        self.publish('rating_summaries_rebuilt',
+                     repository.rebuild_summaries(chunk_size))
+
+
+class RatingSummariesChecker(Publisher):
+    def perform(self, repository, chunk_size):
+        """Check the per-user rating summaries against the recorded rates.
+
+        A 'rating_summaries_consistent' message is published if they all
+        match;  otherwise, a 'rating_summaries_inconsistent' message will be
+        sent back to subscribers, followed by the IDs of the users whose
+        summary does not match.
+        """
+        mismatching = repository.check_summaries(chunk_size)
+        if mismatching:
+            self.publish('rating_summaries_inconsistent', mismatching)
+        else:
+            self.publish('rating_summaries_consistent')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+_MISSING = object()
+
+SERIALIZERS = {}
+
+
+def field(key, convert=None, attrs=None):
+    """Serializes the attributes ``attrs`` (defaulting to ``key``) under
+    ``key``, passing them to ``convert`` first, if given."""
+    return ('field', key, convert, attrs or (key,))
+
+
+def optional(key):
+    """Serializes attribute ``key`` only if the object has it (e.g. it is
+    set by an enricher)."""
+    return ('optional', key)
+
+
+def group(attr, *fields):
+    """Serializes ``fields`` out of ``attr``, unless the latter is None."""
+    return ('group', attr, fields)
+
+
+def nested(key, schema, attr=None):
+    """Serializes ``attr`` (defaulting to ``key``) with ``schema``, inlining
+    the result under ``key``."""
+    return ('nested', key, schema, attr or key)
+
+
+def _expr(obj, spec, namespace):
+    (_, _, convert, attrs) = spec
+    args = ', '.join('%s.%s' % (obj, a) for a in attrs)
+    if convert is None:
+        return args
+    namespace[convert.__name__] = convert
+    return '%s(%s)' % (convert.__name__, args)
+
+
+def _emit(schema, level, indent, namespace, lines, levels):
+    obj = 'o%d' % level
+    out = 'd%d' % level
+    base = []
+    for spec in schema:
+        if spec[0] != 'field':
+            break
+        base.append(spec)
+    lines.append('%s%s = dict(%s)' % (indent, out,
+                                      ', '.join('%s=%s' %
+                                                (spec[1],
+                                                 _expr(obj, spec, namespace))
+                                                for spec in base)))
+    for spec in schema[len(base):]:
+        kind = spec[0]
+        if kind == 'field':
+            lines.append('%s%s.update(%s=%s)' % (indent, out, spec[1],
+                                                 _expr(obj, spec, namespace)))
+        elif kind == 'optional':
+            lines.append('%sv = getattr(%s, %r, _missing)' % (indent, obj,
+                                                              spec[1]))
+            lines.append('%sif v is not _missing:' % indent)
+            lines.append('%s    %s.update(%s=v)' % (indent, out, spec[1]))
+        elif kind == 'group':
+            (_, attr, fields) = spec
+            lines.append('%sp = %s.%s' % (indent, obj, attr))
+            lines.append('%sif p is not None:' % indent)
+            lines.append('%s    %s.update(%s)' %
+                         (indent, out,
+                          ', '.join('%s=%s' % (f[1], _expr('p', f, namespace))
+                                    for f in fields)))
+        elif kind == 'nested':
+            (_, key, nested_schema, attr) = spec
+            levels.append(len(levels))
+            child = levels[-1]
+            lines.append('%so%d = %s.%s' % (indent, child, obj, attr))
+            lines.append('%sif o%d is None:' % (indent, child))
+            lines.append('%s    %s.update(%s=None)' % (indent, out, key))
+            lines.append('%selse:' % indent)
+            _emit(nested_schema, child, indent + '    ', namespace, lines,
+                  levels)
+            lines.append('%s    %s.update(%s=d%d)' % (indent, out, key, child))
+        else:
+            raise ValueError('Unknown field kind: %r' % kind)
+
+
+def compile_serializer(name, schema):
+    """Compiles ``schema`` into a single flat function named ``name``, and
+    registers it in ``SERIALIZERS``.
+
+    Nested schemas are inlined, and optional attributes are probed with a
+    single ``getattr``;  keys are added with the same ``dict(...)`` and
+    ``update(...)`` calls the hand written serializers used, so that the
+    resulting dictionaries (and their iteration order) stay the same.  The
+    generated source is available as the ``source`` attribute of the
+    returned function."""
+    namespace = dict(_missing=_MISSING)
+    lines = ['def %s(o0):' % name,
+             '    if o0 is None:',
+             '        return None']
+    _emit(schema, 0, '    ', namespace, lines, [0])
+    lines.append('    return d0')
+    source = '\n'.join(lines) + '\n'
+    exec source in namespace
+    serializer = namespace[name]
+    serializer.source = source
+    SERIALIZERS[name] = serializer
+    return serializer
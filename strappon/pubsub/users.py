@@ -5,6 +5,11 @@ from functools import partial
 
 from weblib.pubsub import Publisher
 
+from strappon.pubsub.serializers import compile_serializer
+from strappon.pubsub.serializers import field
+from strappon.pubsub.serializers import group
+from strappon.pubsub.serializers import optional
+
 
 class UserWithIdGetter(Publisher):
     def perform(self, repository, user_id):
@@ -77,35 +82,18 @@ class UserUpdater(Publisher):
         self.publish('user_updated', user)
 
 
-def serialize(user):
-    if user is None:
-        return None
-    data = dict(id=user.id, name=user.name, avatar=user.avatar,
-                locale=user.locale)
-    if hasattr(user, 'stars'):
-        data.update(stars=user.stars)
-    if hasattr(user, 'received_rates'):
-        data.update(received_rates=user.received_rates)
-    return data
+USER = [field('id'), field('name'), field('avatar'), field('locale'),
+        optional('stars'), optional('received_rates')]
+USER_WITH_REGION = USER + [group('position', field('region'))]
+USER_WITH_LATLON = USER + [group('position',
+                                 field('latitude'), field('longitude'))]
 
 
-def serialize_with_region(user):
-    if user is None:
-        return None
-    data = serialize(user)
-    if user.position is not None:
-        data.update(region=user.position.region)
-    return data
-
-
-def serialize_with_latlon(user):
-    if user is None:
-        return None
-    data = serialize(user)
-    if user.position is not None:
-        data.update(latitude=user.position.latitude,
-                    longitude=user.position.longitude)
-    return data
+serialize = compile_serializer('serialize_user', USER)
+serialize_with_region = compile_serializer('serialize_user_with_region',
+                                           USER_WITH_REGION)
+serialize_with_latlon = compile_serializer('serialize_user_with_latlon',
+                                           USER_WITH_LATLON)
 
 
 class UserSerializer(Publisher):
@@ -165,11 +153,22 @@ def enrich_common(rates_repository, user):
     return user
 
 
+def enrich_common_many(rates_repository, users):
+    stats = rates_repository.stats_for_users(u.id for u in users)
+    for u in users:
+        (u.stars, u.received_rates) = stats[u.id]
+    return users
+
+
 def enrich(rates_repository, user):
     user = enrich_common(rates_repository, user)
     return user
 
 
+def enrich_many(rates_repository, users):
+    return enrich_common_many(rates_repository, users)
+
+
 def _enrich(rates_repository, user):
     return enrich(rates_repository, user)
 
@@ -217,6 +216,45 @@ class UserEnricherPrivate(Publisher):
                                      user))
 
 
+def enrich_private_profile(profiles_repository, perks_repository, user):
+    """Same as ``enrich_private``, but reads ratings, rides, distances and
+    balances with the single statement of ``profiles_repository.stats``."""
+    stats = profiles_repository.stats(user.id)
+    user.stars = stats.stars
+    user.received_rates = stats.received_rates
+    user.rides_driver = stats.rides_driver
+    user.rides_passenger = stats.rides_passenger
+    user.distance_driver = stats.distance_driver
+    user.distance_passenger = stats.distance_passenger
+    user.eligible_driver_perks = perks_repository.\
+        eligible_driver_perks(user.id)
+    user.active_driver_perks = perks_repository.\
+        active_driver_perks_without_standard_one(user.id)
+    user.eligible_passenger_perks = perks_repository.\
+        eligible_passenger_perks(user.id)
+    user.active_passenger_perks = perks_repository.\
+        active_passenger_perks_without_standard_one(user.id)
+    user.balance = stats.balance
+    user.bonus_balance = stats.bonus_balance
+    return user
+
+
+class UserProfileEnricherPrivate(Publisher):
+    def perform(self, profiles_repository, perks_repository, user):
+        """Enrich the given user with all the details shown on its private
+        profile (ratings, rides, perks and balances), like
+        ``UserEnricherPrivate`` does.
+
+        Ratings, rides, distances and balances are read with a single
+        statement through ``profiles_repository.stats``.  When done, a
+        'user_enriched' message will be published, together with the
+        enriched user.
+        """
+        self.publish('user_enriched',
+                     enrich_private_profile(profiles_repository,
+                                            perks_repository, user))
+
+
 class UsersACSUserIdExtractor(Publisher):
     def perform(self, users):
         self.publish('acs_user_ids_extracted',
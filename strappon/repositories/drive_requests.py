@@ -2,58 +2,72 @@
 # -*- coding: utf-8 -*-
 
 import uuid
+from collections import defaultdict
 from datetime import datetime
 
+from sqlalchemy import DateTime
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 from strappon.models import Base
 from strappon.models import DriveRequest
+from strappon.models import Driver
 from strappon.models import Passenger
+from strappon.models import PendingRating
 from strappon.models import Rate
 from strappon.models import User
+from strappon.models import UserRideStats
 from sqlalchemy.sql.expression import true
 from sqlalchemy.sql.expression import false
+from strappon.repositories.pagination import paginate
 from weblib.db import and_
-from weblib.db import exists
+from weblib.db import contains_eager
 from weblib.db import expunged
 from weblib.db import func
 from weblib.db import joinedload_all
 
 
+DriverUser = aliased(User, name='driver_user')
+PassengerUser = aliased(User, name='passenger_user')
+
+
 class DriveRequestsRepository(object):
     @staticmethod
     def get_unrated_by_id(id, driver_id, user_id):
-        options = [joinedload_all('driver.user'),
-                   joinedload_all('passenger.user')]
-        return expunged(DriveRequest.query.options(*options).
-                        filter(DriveRequest.driver_id == driver_id).
-                        filter(DriveRequest.accepted == true()).
-                        filter(DriveRequest.cancelled == false()).
-                        filter(DriveRequest.active == false()).
-                        filter(Passenger.matched == true()).
-                        filter(~exists().where(and_(Rate.drive_request_id == DriveRequest.id,
-                                                    Rate.rater_user_id == user_id))).
+        return expunged(_get_unrated_by_driver_id(driver_id, user_id).
+                        filter(PendingRating.drive_request_id == id).
                         first(),
-                        DriveRequest.session)
+                        Base.session)
 
     @staticmethod
     def get_unrated_by_driver_id(driver_id, user_id):
-        options = [joinedload_all('driver.user'),
-                   joinedload_all('passenger.user')]
-        return [expunged(dr, DriveRequest.session)
-                for dr in DriveRequest.query.options(*options).
-                filter(DriveRequest.driver_id == driver_id).
-                filter(DriveRequest.accepted == true()).
-                filter(DriveRequest.cancelled == false()).
-                filter(DriveRequest.active == false()).
-                filter(Passenger.matched == true()).
-                filter(~exists().where(and_(Rate.drive_request_id == DriveRequest.id,
-                                            Rate.rater_user_id == user_id)))]
+        return [expunged(dr, Base.session)
+                for dr in _get_unrated_by_driver_id(driver_id, user_id)]
+
+    @staticmethod
+    def get_unrated_by_passenger_id(passenger_id, user_id):
+        return [expunged(dr, Base.session)
+                for dr in _get_unrated_by_passenger_id(passenger_id,
+                                                       user_id)]
+
+    @staticmethod
+    def get_unrated_by_driver_id_page(driver_id, user_id, limit, token):
+        return paginate(_get_unrated_by_driver_id(driver_id, user_id),
+                        DriveRequest, limit, token)
 
     @staticmethod
     def get_all_active():
-        return [expunged(dr, DriveRequest.session)
-                for dr in DriveRequest.query.
-                filter(User.deleted == false()).
-                filter(DriveRequest.active == true())]
+        return list(iter_all_active(500))
+
+    @staticmethod
+    def iter_all_active(batch_size=500):
+        return iter_all_active(batch_size)
+
+    @staticmethod
+    def get_all_active_page(limit, token):
+        return paginate(_get_all_active(), DriveRequest, limit, token)
 
     @staticmethod
     def get_all_active_by_driver(driver_id):
@@ -65,6 +79,11 @@ class DriveRequestsRepository(object):
                 filter(DriveRequest.driver_id == driver_id).
                 filter(DriveRequest.active == true())]
 
+    @staticmethod
+    def get_all_active_by_driver_page(driver_id, limit, token):
+        return paginate(_get_all_active_by_driver(driver_id),
+                        DriveRequest, limit, token)
+
     @staticmethod
     def get_all_active_by_passenger(passenger_id):
         options = [joinedload_all('driver.user'),
@@ -99,63 +118,469 @@ class DriveRequestsRepository(object):
 
     @staticmethod
     def cancel_by_passenger_id(id, passenger_id):
-        request = expunged(DriveRequest.query.
-                           filter_by(id=id).
-                           filter_by(passenger_id=passenger_id).
-                           filter_by(active=True).first(),
-                           DriveRequest.session)
-        if request:
-            request.active = False
-            request.cancelled = True
+        id = _compare_and_set(DriveRequest.query.
+                              filter_by(id=id).
+                              filter_by(passenger_id=passenger_id).
+                              filter_by(active=True),
+                              dict(active=False, cancelled=True))
+        if id is None:
+            return None
+        request = _get(id)
+        if request.accepted:
+            remove_rides([id])
         return request
 
+    @staticmethod
+    def deactivate_all(ids):
+        return deactivate_all(DriveRequest.id.in_(ids)) if ids else []
+
+    @staticmethod
+    def deactivate_all_by_driver_id(driver_id):
+        return deactivate_all(DriveRequest.driver_id == driver_id)
+
+    @staticmethod
+    def deactivate_all_by_passenger_id(passenger_id):
+        return deactivate_all(DriveRequest.passenger_id == passenger_id)
+
+    @staticmethod
+    def cancel_all(ids):
+        return cancel_all(DriveRequest.id.in_(ids)) if ids else []
+
+    @staticmethod
+    def cancel_all_by_driver_id(driver_id):
+        return cancel_all(DriveRequest.driver_id == driver_id)
+
+    @staticmethod
+    def cancel_all_by_passenger_id(passenger_id):
+        return cancel_all(DriveRequest.passenger_id == passenger_id)
+
     @staticmethod
     def accept(driver_id, passenger_id):
-        request = expunged(DriveRequest.query.
-                           filter_by(driver_id=driver_id).
-                           filter_by(passenger_id=passenger_id).
-                           filter_by(accepted=False).
-                           filter_by(active=True).first(),
-                           DriveRequest.session)
-        if request:
-            request.accepted = True
-        return request
+        id = _compare_and_set(DriveRequest.query.
+                              filter_by(driver_id=driver_id).
+                              filter_by(passenger_id=passenger_id).
+                              filter_by(accepted=False).
+                              filter_by(active=True),
+                              dict(accepted=True))
+        if id is None:
+            return None
+        add_rides([id])
+        return _get(id)
+
+    @staticmethod
+    def add_pending_ratings(drive_request_ids):
+        return add_pending_ratings(drive_request_ids)
+
+    @staticmethod
+    def backfill_pending_ratings(chunk_size=1000):
+        return backfill_pending_ratings(chunk_size)
+
+    @staticmethod
+    def remove_rides(drive_request_ids):
+        return remove_rides(drive_request_ids)
+
+    @staticmethod
+    def rides_given(user_id, start, end):
+        return rides_given_many([(user_id, start, end)])[0]
+
+    @staticmethod
+    def rides_given_many(windows, chunk_size=500):
+        return rides_given_many(windows, chunk_size)
 
     @staticmethod
     def rides_driver(user_id):
-        return (Base.session.query(func.count()).
-                select_from(DriveRequest).
-                join('driver', 'user').
-                filter(User.id == user_id).
-                filter(DriveRequest.accepted == true()).
-                first()[0])
+        return (_rides_driver(user_id).first() or (0,))[0]
 
     @staticmethod
     def rides_passenger(user_id):
-        return (Base.session.query(func.count()).
-                select_from(DriveRequest).
-                join('passenger', 'user').
-                filter(User.id == user_id).
-                filter(DriveRequest.accepted == true()).
-                first()[0])
+        return (_rides_passenger(user_id).first() or (0,))[0]
 
     @staticmethod
     def distance_driver(user_id):
-        return (Base.session.query(func.coalesce(func.sum(Passenger.distance),
-                                                 0.0)).
-                select_from(DriveRequest).
-                join('driver', 'user').
-                join('passenger').
-                filter(User.id == user_id).
-                filter(DriveRequest.accepted == true()).
-                first()[0])
+        return (_distance_driver(user_id).first() or (0.0,))[0]
 
     @staticmethod
     def distance_passenger(user_id):
-        return (Base.session.query(func.coalesce(func.sum(Passenger.distance),
-                                                 0.0)).
-                select_from(DriveRequest).
-                join('passenger', 'user').
-                filter(User.id == user_id).
-                filter(DriveRequest.accepted == true()).
-                first()[0])
+        return (_distance_passenger(user_id).first() or (0.0,))[0]
+
+    @staticmethod
+    def rebuild_ride_stats(chunk_size=1000):
+        return rebuild_ride_stats(chunk_size)
+
+
+def _with_users():
+    return (Base.session.query(DriveRequest).
+            options(contains_eager('driver'),
+                    contains_eager('driver.user', alias=DriverUser),
+                    contains_eager('passenger'),
+                    contains_eager('passenger.user', alias=PassengerUser)).
+            select_from(DriveRequest).
+            join(DriveRequest.driver).
+            join(DriverUser, Driver.user).
+            join(DriveRequest.passenger).
+            join(PassengerUser, Passenger.user))
+
+
+def _get(id):
+    return expunged(DriveRequest.query.populate_existing().get(id),
+                    DriveRequest.session)
+
+
+def _compare_and_set(query, values):
+    """Applies ``values`` to the first drive request matched by ``query``,
+    with a conditional UPDATE checking the same criteria again.
+
+    Returns the ID of the updated request, or ``None`` if no request matched
+    or a concurrent update made it stop matching;  in other words, among
+    concurrent callers, only the one winning the UPDATE gets the ID."""
+    candidate = query.with_entities(DriveRequest.id).first()
+    if candidate is None:
+        return None
+    (id,) = candidate
+    updated = (query.
+               filter(DriveRequest.id == id).
+               update(values, synchronize_session=False))
+    return id if updated else None
+
+
+def _update_active(criteria, values):
+    """Applies ``values`` to all the active drive requests matching
+    ``criteria`` with a single UPDATE, returning the (id, accepted) tuples
+    of the affected rows.
+
+    Dialects not supporting UPDATE ... RETURNING (e.g. SQLite) first select
+    and lock the matching rows, and then update them checking ``criteria``
+    again;  if any row was skipped, the ones now holding ``values`` are
+    selected back."""
+    table = DriveRequest.__table__
+    criteria = and_(DriveRequest.active == true(), *criteria)
+    if Base.session.bind.dialect.implicit_returning:
+        return Base.session.execute(table.update().
+                                    where(criteria).
+                                    values(values).
+                                    returning(table.c.id,
+                                              table.c.accepted)).fetchall()
+    rows = (Base.session.query(DriveRequest.id, DriveRequest.accepted).
+            filter(criteria).
+            with_for_update().all())
+    if not rows:
+        return rows
+    ids = [id for (id, _) in rows]
+    updated = (Base.session.query(DriveRequest).
+               filter(DriveRequest.id.in_(ids)).
+               filter(criteria).
+               update(values, synchronize_session=False))
+    if updated < len(rows):
+        rows = (Base.session.query(DriveRequest.id, DriveRequest.accepted).
+                filter(DriveRequest.id.in_(ids)).
+                filter_by(**values).
+                all())
+    return rows
+
+
+def deactivate_all(*criteria):
+    """Deactivates, without loading them, all the active drive requests
+    matching ``criteria``;  returns the IDs of the deactivated requests."""
+    return [id for (id, _) in _update_active(criteria,
+                                             dict(active=False))]
+
+
+def cancel_all(*criteria):
+    """Cancels, without loading them, all the active drive requests
+    matching ``criteria``, removing the accepted ones from the ride stats;
+    returns the IDs of the cancelled requests."""
+    rows = _update_active(criteria, dict(active=False, cancelled=True))
+    remove_rides([id for (id, accepted) in rows if accepted])
+    return [id for (id, _) in rows]
+
+
+def _pending_ratings(user_id):
+    return (_with_users().
+            join(PendingRating,
+                 PendingRating.drive_request_id == DriveRequest.id).
+            filter(PendingRating.user_id == user_id))
+
+
+def _get_unrated_by_driver_id(driver_id, user_id):
+    return (_pending_ratings(user_id).
+            filter(PendingRating.driver_id == driver_id))
+
+
+def _get_unrated_by_passenger_id(passenger_id, user_id):
+    return (_pending_ratings(user_id).
+            filter(PendingRating.passenger_id == passenger_id))
+
+
+def _raters():
+    return (_rides().
+            join(DriveRequest.driver).
+            join(DriveRequest.passenger).
+            with_entities(DriveRequest.id,
+                          DriveRequest.driver_id,
+                          DriveRequest.passenger_id,
+                          Driver.user_id,
+                          Passenger.user_id))
+
+
+def _pending_ratings_of(rows):
+    pending = [dict(drive_request_id=id, user_id=user_id,
+                    driver_id=driver_id, passenger_id=passenger_id)
+               for (id, driver_id, passenger_id,
+                    driver_user_id, passenger_user_id) in rows
+               for user_id in (driver_user_id, passenger_user_id)]
+    if not pending:
+        return []
+    ids = set(p['drive_request_id'] for p in pending)
+    existing = set(Base.session.query(PendingRating.drive_request_id,
+                                      PendingRating.user_id).
+                   filter(PendingRating.drive_request_id.in_(ids)))
+    rated = set(Base.session.query(Rate.drive_request_id,
+                                   Rate.rater_user_id).
+                filter(Rate.drive_request_id.in_(ids)))
+    return [p for p in pending
+            if (p['drive_request_id'], p['user_id']) not in existing | rated]
+
+
+def add_pending_ratings(drive_request_ids):
+    """Queues the given drive requests, just completed, for being rated by
+    both their driver and passenger users;  requests which were not accepted,
+    or were cancelled, are skipped.  Returns the number of queued ratings."""
+    if not drive_request_ids:
+        return 0
+    pending = _pending_ratings_of(_raters().
+                                  filter(DriveRequest.id.
+                                         in_(drive_request_ids)))
+    if pending:
+        Base.session.execute(PendingRating.__table__.insert(), pending)
+    return len(pending)
+
+
+def backfill_pending_ratings(chunk_size):
+    """Queues for rating all the completed drive requests still missing a
+    rate from their driver or passenger user, ``chunk_size`` requests at a
+    time;  returns the number of queued ratings."""
+    backfilled = 0
+    after = None
+    while True:
+        query = (_raters().
+                 filter(DriveRequest.active == false()).
+                 filter(Passenger.matched == true()))
+        if after is not None:
+            query = query.filter(DriveRequest.id > after)
+        rows = query.order_by(DriveRequest.id).limit(chunk_size).all()
+        if not rows:
+            return backfilled
+        pending = _pending_ratings_of(rows)
+        if pending:
+            Base.session.execute(PendingRating.__table__.insert(), pending)
+        backfilled += len(pending)
+        after = rows[-1][0]
+
+
+def _get_all_active():
+    return (_with_users().
+            filter(DriverUser.deleted == false()).
+            filter(PassengerUser.deleted == false()).
+            filter(DriveRequest.active == true()))
+
+
+def iter_all_active(batch_size):
+    """Yields the active drive requests, together with their driver and
+    passenger (and their users), fetching ``batch_size`` rows at a time."""
+    for dr in _get_all_active().yield_per(batch_size):
+        yield expunged(dr, Base.session)
+
+
+def _get_all_active_by_driver(driver_id):
+    return (_get_all_active().
+            filter(DriveRequest.driver_id == driver_id))
+
+
+def _update_ride_stats(drive_request_ids, sign):
+    rows = (Base.session.query(Driver.user_id, Passenger.user_id,
+                               Passenger.distance).
+            select_from(DriveRequest).
+            join(DriveRequest.driver).
+            join(DriveRequest.passenger).
+            filter(DriveRequest.id.in_(drive_request_ids)))
+    deltas = defaultdict(lambda: [0, 0, 0.0, 0.0])
+    for (driver_user_id, passenger_user_id, distance) in rows:
+        deltas[driver_user_id][0] += sign
+        deltas[driver_user_id][2] += sign * distance
+        deltas[passenger_user_id][1] += sign
+        deltas[passenger_user_id][3] += sign * distance
+    for (user_id, (rides_driver, rides_passenger,
+                   distance_driver, distance_passenger)) in deltas.items():
+        values = {UserRideStats.rides_driver:
+                  UserRideStats.rides_driver + rides_driver,
+                  UserRideStats.rides_passenger:
+                  UserRideStats.rides_passenger + rides_passenger,
+                  UserRideStats.distance_driver:
+                  UserRideStats.distance_driver + distance_driver,
+                  UserRideStats.distance_passenger:
+                  UserRideStats.distance_passenger + distance_passenger}
+        query = (Base.session.query(UserRideStats).
+                 filter(UserRideStats.user_id == user_id))
+        if not query.update(values, synchronize_session=False):
+            _add_empty_ride_stats(user_id)
+            query.update(values, synchronize_session=False)
+
+
+def _add_empty_ride_stats(user_id):
+    """Inserts empty ride stats for ``user_id``, unless a concurrent
+    transaction already did (e.g. for the first ride of the user)."""
+    try:
+        with Base.session.begin_nested():
+            Base.session.execute(UserRideStats.__table__.insert(),
+                                 dict(user_id=user_id))
+    except IntegrityError:
+        pass
+
+
+def add_rides(drive_request_ids):
+    """Adds the given, just accepted, drive requests to the ride stats of
+    their driver and passenger users."""
+    if drive_request_ids:
+        _update_ride_stats(drive_request_ids, 1)
+
+
+def remove_rides(drive_request_ids):
+    """Removes the given, previously accepted, drive requests from the ride
+    stats of their driver and passenger users."""
+    if drive_request_ids:
+        _update_ride_stats(drive_request_ids, -1)
+
+
+def _rides():
+    return (Base.session.query(DriveRequest).
+            filter(DriveRequest.accepted == true()).
+            filter(DriveRequest.cancelled == false()))
+
+
+def _ride_user_ids():
+    drivers = (_rides().join(DriveRequest.driver).
+               with_entities(Driver.user_id.label('user_id')))
+    passengers = (_rides().join(DriveRequest.passenger).
+                  with_entities(Passenger.user_id.label('user_id')))
+    return drivers.union(passengers).subquery()
+
+
+def _users_with_rides(after, limit):
+    user_ids = _ride_user_ids()
+    query = Base.session.query(user_ids.c.user_id)
+    if after is not None:
+        query = query.filter(user_ids.c.user_id > after)
+    return [user_id for (user_id,) in (query.
+                                       order_by(user_ids.c.user_id).
+                                       limit(limit))]
+
+
+def _chunks(chunk_size):
+    after = None
+    while True:
+        user_ids = _users_with_rides(after, chunk_size)
+        if not user_ids:
+            return
+        yield user_ids
+        after = user_ids[-1]
+
+
+def _rides_by(user_id_column, user_ids):
+    return (_rides().
+            join(DriveRequest.driver).
+            join(DriveRequest.passenger).
+            with_entities(user_id_column, func.count(),
+                          func.sum(Passenger.distance)).
+            filter(user_id_column.in_(user_ids)).
+            group_by(user_id_column))
+
+
+def _ride_stats_from_rides(user_ids):
+    stats = dict((user_id, dict(user_id=user_id,
+                                rides_driver=0, rides_passenger=0,
+                                distance_driver=0.0, distance_passenger=0.0))
+                 for user_id in user_ids)
+    for (role, user_id_column) in [('driver', Driver.user_id),
+                                   ('passenger', Passenger.user_id)]:
+        for (user_id, rides, distance) in _rides_by(user_id_column, user_ids):
+            stats[user_id]['rides_' + role] = int(rides)
+            stats[user_id]['distance_' + role] = float(distance or 0.0)
+    return stats.values()
+
+
+def rebuild_ride_stats(chunk_size):
+    """Recomputes the ride stats out of the accepted, and not cancelled,
+    drive requests, ``chunk_size`` users at a time;  returns the number of
+    stats written."""
+    table = UserRideStats.__table__
+    Base.session.execute(table.delete().
+                         where(~table.c.user_id.in_(_ride_user_ids().
+                                                    select())))
+    rebuilt = 0
+    for user_ids in _chunks(chunk_size):
+        stats = _ride_stats_from_rides(user_ids)
+        Base.session.execute(table.delete().
+                             where(table.c.user_id.in_(user_ids)))
+        Base.session.execute(table.insert(), stats)
+        rebuilt += len(stats)
+    return rebuilt
+
+
+def _windows(windows):
+    return union_all(*[select([literal(i).label('idx'),
+                               literal(user_id).label('user_id'),
+                               literal(start, DateTime).label('window_start'),
+                               literal(end, DateTime).label('window_end')])
+                       for (i, (user_id, start, end))
+                       in enumerate(windows)]).alias('windows')
+
+
+def _rides_given(windows):
+    rides = (_rides().
+             join(DriveRequest.driver).
+             with_entities(Driver.user_id.label('user_id'),
+                           DriveRequest.created.label('created')).
+             subquery())
+    windows = _windows(windows)
+    return (Base.session.query(windows.c.idx, func.count(rides.c.user_id)).
+            select_from(windows).
+            outerjoin(rides, and_(rides.c.user_id == windows.c.user_id,
+                                  rides.c.created >= windows.c.window_start,
+                                  rides.c.created <= windows.c.window_end)).
+            group_by(windows.c.idx))
+
+
+def rides_given_many(windows, chunk_size=500):
+    """Returns, for each of the given (user_id, start, end) windows, the
+    number of accepted, and not cancelled, drive requests the user gave as
+    a driver between ``start`` and ``end`` (both included).
+
+    Each chunk of ``chunk_size`` windows is counted by a single aggregate
+    query, joining the rides with the windows themselves."""
+    windows = list(windows)
+    rides_given = [0] * len(windows)
+    for offset in xrange(0, len(windows), chunk_size):
+        for (idx, count) in _rides_given(windows[offset:offset + chunk_size]):
+            rides_given[offset + int(idx)] = count
+    return rides_given
+
+
+def _ride_stats_column(user_id, column):
+    return (Base.session.query(column).
+            filter(UserRideStats.user_id == user_id))
+
+
+def _rides_driver(user_id):
+    return _ride_stats_column(user_id, UserRideStats.rides_driver)
+
+
+def _rides_passenger(user_id):
+    return _ride_stats_column(user_id, UserRideStats.rides_passenger)
+
+
+def _distance_driver(user_id):
+    return _ride_stats_column(user_id, UserRideStats.distance_driver)
+
+
+def _distance_passenger(user_id):
+    return _ride_stats_column(user_id, UserRideStats.distance_passenger)
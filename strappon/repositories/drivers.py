@@ -9,6 +9,7 @@ from strappon.models import Base
 from strappon.models import User
 from strappon.models import UserPosition
 from strappon.models import Driver
+from strappon.repositories.pagination import paginate
 from weblib.db import contains_eager
 from weblib.db import expunged
 from weblib.db import joinedload
@@ -47,10 +48,22 @@ class DriversRepository(object):
     def get_all_unhidden():
         return get_all_unhidden()
 
+    @staticmethod
+    def get_all_unhidden_page(limit, token):
+        return paginate(_get_all_unhidden(), Driver, limit, token)
+
     @staticmethod
     def get_unhidden_by_region(region):
         return get_all_unhidden_by_region(region)
 
+    @staticmethod
+    def get_all_unhidden_positions():
+        return get_all_unhidden_positions()
+
+    @staticmethod
+    def get_unhidden_id_by_user_id(user_id):
+        return get_unhidden_id_by_user_id(user_id)
+
     @staticmethod
     def with_user_id(user_id):
         return expunged(Driver.query.options(joinedload('user')).\
@@ -85,7 +98,7 @@ def get_all_unhidden():
 
 def _get_all_unhidden_by_region(region):
     return (Base.session.query(Driver).
-            options(contains_eager('user')).
+            options(contains_eager('user').joinedload('position')).
             select_from(Driver, User).
             join(User).
             outerjoin(UserPosition).
@@ -99,3 +112,27 @@ def _get_all_unhidden_by_region(region):
 def get_all_unhidden_by_region(region):
     return [expunged(d, Driver.session)
             for d in _get_all_unhidden_by_region(region)]
+
+
+def _get_all_unhidden_positions():
+    return (Base.session.query(Driver.id, Driver.user_id,
+                               UserPosition.latitude, UserPosition.longitude).
+            select_from(Driver).
+            join(User).
+            join(User.position).
+            filter(User.deleted == false()).
+            filter(Driver.hidden == false()).
+            filter(Driver.active == true()).
+            order_by(UserPosition.created))
+
+
+def get_all_unhidden_positions():
+    return _get_all_unhidden_positions().all()
+
+
+def get_unhidden_id_by_user_id(user_id):
+    row = (_get_all_unhidden().
+           with_entities(Driver.id).
+           filter(Driver.user_id == user_id).
+           first())
+    return None if row is None else row[0]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+from weblib.db import and_
+from weblib.db import expunged
+from weblib.db import or_
+
+
+Page = namedtuple('Page', 'items token'.split())
+
+
+def encode_token(created, id):
+    return urlsafe_b64encode('%s %s' % (created.isoformat(), id))
+
+
+def decode_token(token):
+    """Returns the (created, id) tuple wrapped inside ``token``;  raises
+    ``ValueError`` if the token is not a valid one."""
+    try:
+        (created, id) = urlsafe_b64decode(str(token)).split(' ', 1)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page token: %r' % token)
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in created else '%Y-%m-%dT%H:%M:%S'
+    return (datetime.strptime(created, fmt), id.decode('utf-8'))
+
+
+def paginate(query, entity, limit, token, descending=False):
+    """Returns the ``Page`` of at most ``limit`` items of ``query`` following
+    the one ``token`` was handed out with (the first page if ``token`` is
+    ``None``).
+
+    Items are sorted by (``entity.created``, ``entity.id``) and the next page
+    starts right after the last item of the current one, so that the
+    database can seek to it instead of skipping all the previous rows;  the
+    token of the last page is ``None``.
+    """
+    created = entity.created
+    id = entity.id
+    if token is not None:
+        (last_created, last_id) = decode_token(token)
+        if descending:
+            query = query.filter(or_(created < last_created,
+                                     and_(created == last_created,
+                                          id < last_id)))
+        else:
+            query = query.filter(or_(created > last_created,
+                                     and_(created == last_created,
+                                          id > last_id)))
+    if descending:
+        query = query.order_by(created.desc(), id.desc())
+    else:
+        query = query.order_by(created, id)
+    items = [expunged(i, query.session) for i in query.limit(limit + 1)]
+    if len(items) > limit:
+        items = items[:limit]
+        return Page(items, encode_token(items[-1].created, items[-1].id))
+    return Page(items, None)
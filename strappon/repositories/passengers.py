@@ -2,17 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import uuid
+from collections import namedtuple
 from datetime import datetime
 from datetime import timedelta
 
 from sqlalchemy.sql.expression import true
 from sqlalchemy.sql.expression import false
 from sqlalchemy.sql.expression import null
+from sqlalchemy.sql.expression import select
 from strappon.models import Base
 from strappon.models import DriveRequest
 from strappon.models import Passenger
 from strappon.models import UserPosition
 from strappon.models import User
+from strappon.repositories.pagination import paginate
 from weblib.db import and_
 from weblib.db import contains_eager
 from weblib.db import or_
@@ -20,6 +23,14 @@ from weblib.db import expunged
 from weblib.db import joinedload
 
 
+ExpiredPassenger = namedtuple('ExpiredPassenger', 'id user_id'.split())
+PassengersDelta = namedtuple('PassengersDelta',
+                             'passengers removed_ids cursor'.split())
+
+
+UNMATCHED_CURSOR_LAG = timedelta(minutes=1)
+
+
 class PassengersRepository(object):
     @staticmethod
     def get(id):
@@ -63,18 +74,34 @@ class PassengersRepository(object):
     def get_all_unmatched():
         return get_all_unmatched()
 
+    @staticmethod
+    def get_all_unmatched_page(limit, token):
+        return paginate(_get_all_unmatched(), Passenger, limit, token)
+
     @staticmethod
     def get_all_unmatched_by_region(region):
         return get_all_unmatched_by_region(region)
 
+    @staticmethod
+    def get_unmatched_by_region_since(region, cursor):
+        return get_unmatched_by_region_since(region, cursor)
+
     @staticmethod
     def get_all_expired(expire_after):
         return get_all_expired(expire_after)
 
+    @staticmethod
+    def deactivate_all_expired(expire_after, chunk_size=500):
+        return deactivate_all_expired(expire_after, chunk_size)
+
     @staticmethod
     def get_all_active():
         return get_all_active()
 
+    @staticmethod
+    def get_all_active_page(limit, token):
+        return paginate(_get_all_active(), Passenger, limit, token)
+
     @staticmethod
     def add(user_id, origin, origin_latitude, origin_longitude,
             destination, destination_latitude, destination_longitude, distance,
@@ -172,6 +199,50 @@ def get_all_unmatched_by_region(region):
             for p in _get_all_unmatched_by_region(region)]
 
 
+def _get_by_region_updated_since(region, since):
+    return (Base.session.query(Passenger).
+            options(contains_eager('user')).
+            select_from(Passenger).
+            join(User).
+            outerjoin(UserPosition).
+            filter(or_(UserPosition.region.is_(None),
+                       UserPosition.region == region)).
+            filter(Passenger.updated >= since).
+            order_by(Passenger.updated))
+
+
+def get_unmatched_by_region_since(region, cursor):
+    """Returns the changes to the set of unmatched passengers of the given
+    region, since ``cursor`` (i.e. the ``updated`` timestamp of the last
+    change seen by the client, or ``None`` for the whole set).
+
+    Passengers still active and unmatched are returned in full, while the
+    ones matched, deactivated, or whose user got deleted are only listed by
+    ID.  The cursor to pass to the next invocation is returned as well.
+
+    ``updated`` is set when a change is flushed, not when it is committed,
+    so changes committed late could carry a timestamp older than the
+    cursor:  the last ``UNMATCHED_CURSOR_LAG`` before it are read again,
+    hence clients should expect (and deduplicate by ID) passengers they have
+    already seen.
+    """
+    if cursor is None:
+        passengers = get_all_unmatched_by_region(region)
+        return PassengersDelta(passengers, [],
+                               max([p.updated for p in passengers] or
+                                   [None]))
+    passengers = []
+    removed_ids = []
+    for p in _get_by_region_updated_since(region,
+                                          cursor - UNMATCHED_CURSOR_LAG):
+        if p.active and not p.matched and not p.user.deleted:
+            passengers.append(expunged(p, Base.session))
+        else:
+            removed_ids.append(p.id)
+        cursor = max(cursor, p.updated)
+    return PassengersDelta(passengers, removed_ids, cursor)
+
+
 def _get_all_active():
     return (Base.session.query(Passenger).
             options(contains_eager('user')).
@@ -186,21 +257,88 @@ def get_all_active():
             for p in _get_all_active()]
 
 
-def _get_all_expired(expire_after):
+def _expired(expire_after):
     expire_date = datetime.utcnow() - timedelta(minutes=expire_after)
+    return and_(Passenger.active == true(),
+                Passenger.matched == false(),
+                or_(and_(Passenger.pickup_time_new == null(),
+                         Passenger.created < expire_date),
+                    and_(Passenger.pickup_time_new != null(),
+                         Passenger.pickup_time_new < expire_date)))
+
+
+def _get_all_expired(expire_after):
     return (Base.session.query(Passenger).
             options(contains_eager('user')).
             select_from(Passenger).
             join(User).
             filter(User.deleted == false()).
-            filter(Passenger.active == true()).
-            filter(Passenger.matched == false()).
-            filter(or_(and_(Passenger.pickup_time_new == null(),
-                            Passenger.created < expire_date),
-                       and_(Passenger.pickup_time_new != null(),
-                            Passenger.pickup_time_new < expire_date))))
+            filter(_expired(expire_after)))
 
 
 def get_all_expired(expire_after):
     return [expunged(p, Base.session)
             for p in _get_all_expired(expire_after)]
+
+
+def _get_expired_ids(expire_after, limit):
+    return (Base.session.query(Passenger.id, Passenger.user_id).
+            select_from(Passenger).
+            join(User).
+            filter(User.deleted == false()).
+            filter(_expired(expire_after)).
+            limit(limit))
+
+
+def _deactivate_expired(expire_after, limit):
+    """Deactivates up to ``limit`` expired passengers, returning the
+    ``ExpiredPassenger`` tuples of the affected rows, or None if there were
+    no expired passengers left.
+
+    Dialects not supporting UPDATE ... RETURNING (e.g. SQLite) first select
+    and lock the expired rows, and then update them checking the expiration
+    predicate again;  if any row was skipped, the ones actually deactivated
+    are selected back."""
+    table = Passenger.__table__
+    if Base.session.bind.dialect.implicit_returning:
+        ids = (_get_expired_ids(expire_after, limit).
+               with_entities(Passenger.id).
+               subquery())
+        rows = Base.session.execute(table.update().
+                                    where(table.c.id.in_(select([ids.c.id]))).
+                                    where(_expired(expire_after)).
+                                    values(active=False).
+                                    returning(table.c.id,
+                                              table.c.user_id)).fetchall()
+        return [ExpiredPassenger(*r) for r in rows] or None
+    rows = _get_expired_ids(expire_after, limit).with_for_update().all()
+    if not rows:
+        return None
+    ids = [id for (id, _) in rows]
+    updated = (Base.session.query(Passenger).
+               filter(Passenger.id.in_(ids)).
+               filter(_expired(expire_after)).
+               update({Passenger.active: False}, synchronize_session=False))
+    if updated < len(rows):
+        rows = (Base.session.query(Passenger.id, Passenger.user_id).
+                filter(Passenger.id.in_(ids)).
+                filter(Passenger.active == false()).
+                filter(Passenger.matched == false()).
+                all())
+    return [ExpiredPassenger(*r) for r in rows]
+
+
+def deactivate_all_expired(expire_after, chunk_size):
+    """Deactivates expired passengers without loading them, ``chunk_size``
+    rows per UPDATE statement.
+
+    Passengers matched in the meantime are left alone;  returns the list of
+    ``ExpiredPassenger`` (id, user_id) tuples of the deactivated ones.
+    """
+    expired = []
+    while True:
+        chunk = _deactivate_expired(expire_after, chunk_size)
+        if chunk is None:
+            break
+        expired.extend(chunk)
+    return expired
@@ -2,12 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import uuid
+from collections import namedtuple
+from datetime import datetime
 from math import fsum
-from itertools import groupby
 
+from sqlalchemy import case
 from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import union
+from sqlalchemy import union_all
+from sqlalchemy.sql.expression import null
+from strappon.models import BalanceCheckpoint
 from strappon.models import Base
 from strappon.models import Payment
+from weblib.db import func
+
+
+Settlement = namedtuple('Settlement',
+                        'drive_request_id payer_user_id payee_user_id '
+                        'credits promo_code_id'.split())
 
 
 class PaymentsRepository(object):
@@ -22,10 +35,26 @@ class PaymentsRepository(object):
                        bonus_credits=bonus_credits,
                        promo_code_id=promo_code_id)
 
+    @staticmethod
+    def add_many(settlements, batch_size=1000):
+        return add_many(settlements, batch_size)
+
     @staticmethod
     def detailed_balance(user_id):
         return detailed_balance(user_id)
 
+    @staticmethod
+    def roll_checkpoints(until, chunk_size=1000):
+        return roll_checkpoints(until, chunk_size)
+
+    @staticmethod
+    def verify_checkpoints(chunk_size=1000):
+        return verify_checkpoints(chunk_size)
+
+    @staticmethod
+    def balances(user_id):
+        return balances(user_id)
+
     @staticmethod
     def balance(user_id):
         return balance(user_id)
@@ -35,6 +64,38 @@ class PaymentsRepository(object):
         return bonus_balance(user_id)
 
 
+def add_many(settlements, batch_size):
+    """Inserts one payment for each of the given ``Settlement`` tuples,
+    ``batch_size`` rows per INSERT statement, and returns the IDs of the
+    created payments.
+
+    Credits of settlements linked to a promo code are recorded as bonus
+    credits, while the bonus credits of the other ones are zero, exactly like
+    ``FareCreator`` does.
+    """
+    table = Payment.__table__
+    ids = []
+    batch = []
+    for s in settlements:
+        id = unicode(uuid.uuid4())
+        now = datetime.utcnow()
+        bonus = s.promo_code_id is not None
+        batch.append(dict(id=id, created=now, updated=now,
+                          drive_request_id=s.drive_request_id,
+                          payer_user_id=s.payer_user_id,
+                          payee_user_id=s.payee_user_id,
+                          credits=0 if bonus else s.credits,
+                          bonus_credits=s.credits if bonus else 0,
+                          promo_code_id=s.promo_code_id))
+        ids.append(id)
+        if len(batch) == batch_size:
+            Base.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        Base.session.execute(table.insert(), batch)
+    return ids
+
+
 def signed_credits(payment):
     credits = (payment.credits
                if payment.promo_code_id is None
@@ -43,22 +104,227 @@ def signed_credits(payment):
     return credits
 
 
+def _signed_credits():
+    credits = case([(Payment.promo_code_id == null(), Payment.credits)],
+                   else_=Payment.bonus_credits)
+    return case([(Payment.payee_user_id != null(), credits)],
+                else_=-credits)
+
+
+def _payments_of(user_ids, *criteria):
+    """Selects the (user_id, promo_code_id, credits) of the payments of the
+    given users, one row for each user a payment belongs to;  ``criteria``
+    are functions of the user ID column, returning additional filters."""
+    def columns(user_id):
+        return [user_id.label('user_id'),
+                Payment.promo_code_id.label('promo_code_id'),
+                _signed_credits().label('credits')]
+    payee = (select(columns(Payment.payee_user_id)).
+             where(Payment.payee_user_id.in_(user_ids)))
+    payer = (select(columns(Payment.payer_user_id)).
+             where(Payment.payer_user_id.in_(user_ids)).
+             where(or_(Payment.payee_user_id == null(),
+                       Payment.payee_user_id != Payment.payer_user_id)))
+    for criterion in criteria:
+        payee = payee.where(criterion(Payment.payee_user_id))
+        payer = payer.where(criterion(Payment.payer_user_id))
+    return [payee, payer]
+
+
+def _checkpoint_of(user_id):
+    return (select([func.max(BalanceCheckpoint.until)]).
+            where(BalanceCheckpoint.user_id == user_id).
+            as_scalar())
+
+
+def _after_checkpoint(user_id):
+    cutoff = _checkpoint_of(user_id)
+    return or_(cutoff == null(), Payment.created >= cutoff)
+
+
+def _before_checkpoint(user_id):
+    return Payment.created < _checkpoint_of(user_id)
+
+
+def _created_before(until):
+    return lambda user_id: Payment.created < until
+
+
+def _checkpoints_of(user_ids):
+    return (select([BalanceCheckpoint.user_id,
+                    BalanceCheckpoint.promo_code_id,
+                    BalanceCheckpoint.credits]).
+            where(BalanceCheckpoint.user_id.in_(user_ids)))
+
+
+def _balance_rows(user_ids, *criteria):
+    """Checkpointed totals of the given users, plus their payments created
+    after the checkpoint."""
+    return union_all(_checkpoints_of(user_ids),
+                     *_payments_of(user_ids, _after_checkpoint,
+                                   *criteria)).alias('balance_rows')
+
+
+def _detailed_balance(user_id):
+    rows = _balance_rows([user_id])
+    return (Base.session.query(func.sum(rows.c.credits),
+                               rows.c.promo_code_id).
+            group_by(rows.c.promo_code_id).
+            order_by(rows.c.promo_code_id))
+
+
 def detailed_balance(user_id):
-    query = list(Base.session.query(Payment).
-                 filter(or_(Payment.payee_user_id == user_id,
-                            Payment.payer_user_id == user_id)).
-                 order_by(Payment.promo_code_id))
-    return [(fsum(map(signed_credits, g)), k)
-            for k, g in groupby(query, lambda p: p.promo_code_id)]
+    return [(float(credits), promo_code_id)
+            for (credits, promo_code_id) in _detailed_balance(user_id)]
+
+
+def split_balance(detailed_balance):
+    """Returns the (balance, bonus balance) tuple out of the given detailed
+    balance."""
+    return (fsum(credits for (credits, promo) in detailed_balance
+                 if promo is None),
+            fsum(credits for (credits, promo) in detailed_balance
+                 if promo is not None))
+
+
+def balances(user_id):
+    return split_balance(detailed_balance(user_id))
 
 
 def balance(user_id):
-    return fsum(map(lambda (credits, promo): credits,
-                    filter(lambda (credits, promo): promo is None,
-                           detailed_balance(user_id))))
+    return balances(user_id)[0]
 
 
 def bonus_balance(user_id):
-    return fsum(map(lambda (credits, promo): credits,
-                    filter(lambda (credits, promo): promo is not None,
-                           detailed_balance(user_id))))
+    return balances(user_id)[1]
+
+
+def _signed_credits_sum(user_id, bonus):
+    """Same as summing the balance of the user on the database side:  only
+    bonus payments (i.e. linked to a promo code) are summed if ``bonus`` is
+    set, only regular ones otherwise."""
+    rows = _balance_rows([user_id])
+    kind = (rows.c.promo_code_id != null() if bonus
+            else rows.c.promo_code_id == null())
+    return Base.session.query(func.sum(rows.c.credits)).filter(kind)
+
+
+def _users_with_payments(after, limit, *criteria):
+    def user_ids(user_id):
+        query = select([user_id.label('user_id')]).where(user_id != null())
+        for criterion in criteria:
+            query = query.where(criterion)
+        return query
+    users = union(user_ids(Payment.payee_user_id),
+                  user_ids(Payment.payer_user_id)).alias('users')
+    query = Base.session.query(users.c.user_id)
+    if after is not None:
+        query = query.filter(users.c.user_id > after)
+    return [user_id
+            for (user_id,) in query.order_by(users.c.user_id).limit(limit)]
+
+
+def _chunks(users, chunk_size):
+    after = None
+    while True:
+        user_ids = users(after, chunk_size)
+        if not user_ids:
+            return
+        yield user_ids
+        after = user_ids[-1]
+
+
+def roll_checkpoints(until, chunk_size):
+    """Moves the balance checkpoints of the users forward to ``until``,
+    ``chunk_size`` users at a time;  returns the number of users whose
+    checkpoint got rolled.
+
+    Only the users with payments created after the oldest checkpoint are
+    considered.  ``until`` should lag behind the current time (i.e. a few
+    minutes ago), so that payments still being committed are not left
+    behind the checkpoint.
+    """
+    oldest = select([func.min(BalanceCheckpoint.until)]).as_scalar()
+    since_oldest = or_(oldest == null(), Payment.created >= oldest)
+
+    def users(after, limit):
+        return _users_with_payments(after, limit, since_oldest)
+
+    table = BalanceCheckpoint.__table__
+    rolled = 0
+    for user_ids in _chunks(users, chunk_size):
+        rows = _balance_rows(user_ids, _created_before(until))
+        totals = (Base.session.query(rows.c.user_id,
+                                     rows.c.promo_code_id,
+                                     func.sum(rows.c.credits)).
+                  group_by(rows.c.user_id, rows.c.promo_code_id).
+                  all())
+        Base.session.execute(table.delete().
+                             where(table.c.user_id.in_(user_ids)))
+        if totals:
+            Base.session.execute(table.insert(),
+                                 [dict(id=unicode(uuid.uuid4()),
+                                       user_id=user_id,
+                                       promo_code_id=promo_code_id,
+                                       credits=int(credits),
+                                       until=until)
+                                  for (user_id, promo_code_id, credits)
+                                  in totals])
+        rolled += len(user_ids)
+    _advance_checkpoints(until, chunk_size)
+    return rolled
+
+
+def _advance_checkpoints(until, chunk_size):
+    """Moves forward to ``until`` the checkpoints left behind, i.e. the ones
+    of the users without payments since, ``chunk_size`` rows per UPDATE
+    statement;  this way the oldest checkpoint, hence the payments scanned
+    by the next roll, keeps up with the rolls."""
+    behind = BalanceCheckpoint.until < until
+    while True:
+        ids = [id for (id,) in (Base.session.query(BalanceCheckpoint.id).
+                                filter(behind).
+                                limit(chunk_size))]
+        if not ids:
+            return
+        (Base.session.query(BalanceCheckpoint).
+         filter(BalanceCheckpoint.id.in_(ids)).
+         filter(behind).
+         update({BalanceCheckpoint.until: until}, synchronize_session=False))
+
+
+def _users_with_checkpoints(after, limit):
+    query = Base.session.query(BalanceCheckpoint.user_id)
+    if after is not None:
+        query = query.filter(BalanceCheckpoint.user_id > after)
+    return [user_id
+            for (user_id,) in (query.
+                               group_by(BalanceCheckpoint.user_id).
+                               order_by(BalanceCheckpoint.user_id).
+                               limit(limit))]
+
+
+def _totals(rows):
+    return dict(((user_id, promo_code_id), int(credits))
+                for (user_id, promo_code_id, credits)
+                in (Base.session.query(rows.c.user_id,
+                                       rows.c.promo_code_id,
+                                       func.sum(rows.c.credits)).
+                    group_by(rows.c.user_id, rows.c.promo_code_id)))
+
+
+def verify_checkpoints(chunk_size):
+    """Rebuilds the checkpointed totals from scratch, out of the payments
+    created before each checkpoint, and compares them with the stored ones;
+    returns the IDs of the users whose checkpoint does not match."""
+    mismatching = []
+    for user_ids in _chunks(_users_with_checkpoints, chunk_size):
+        expected = _totals(union_all(*_payments_of(user_ids,
+                                                   _before_checkpoint)).
+                           alias('payments'))
+        actual = _totals(_checkpoints_of(user_ids).alias('checkpoints'))
+        mismatching.extend(sorted(set(user_id
+                                      for ((user_id, _), _)
+                                      in (set(expected.items()) ^
+                                          set(actual.items())))))
+    return mismatching
@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 
 
+import time
 import uuid
 from collections import namedtuple
 from datetime import date
 from datetime import timedelta
 
-from sqlalchemy.orm import joinedload
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import joinedload_all
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql.expression import false
 from sqlalchemy.sql.expression import true
 from strappon.models import ActiveDriverPerk
@@ -18,7 +24,9 @@ from strappon.models import DriverPerk
 from strappon.models import EligibleDriverPerk
 from strappon.models import EligiblePassengerPerk
 from strappon.models import PassengerPerk
+from strappon.models import PerkCampaignCheckpoint
 from strappon.models import User
+from strappon.repositories.pagination import paginate
 from weblib.db import and_
 from weblib.db import exists
 from weblib.db import expunged
@@ -27,6 +35,120 @@ from weblib.db import expunged
 EnrichedEligibleDriverPerk = namedtuple('EnrichedEligibleDriverPerk',
                                         'perk rides_given'.split())
 
+SweptPerks = namedtuple('SweptPerks',
+                        'eligible_driver active_driver '
+                        'eligible_passenger active_passenger'.split())
+
+CampaignChunk = namedtuple('CampaignChunk',
+                           'campaign eligible activated completed'.split())
+
+
+PERKS_CATALOG_TTL = 300
+
+
+class PerksCatalog(object):
+    """Process-local copy of the perk definitions of ``model`` (i.e.
+    ``DriverPerk`` or ``PassengerPerk``), which change a few times a year.
+
+    The whole table is re-read at most every ``ttl`` seconds, as soon as the
+    catalog is invalidated (i.e. once a transaction writing to ``model`` is
+    committed), or when asked for a perk it does not know yet;  ``version``
+    is bumped on every invalidation.  Only commits of the current process
+    invalidate the catalog, so changes made by other processes to existing
+    perks (e.g. a perk getting deleted) show up to ``ttl`` seconds late.
+
+    Perks are read as plain rows, and cached as detached copies, leaving
+    the instances loaded by the caller's session alone;  the copies are
+    shared among callers, so they should not be modified."""
+
+    def __init__(self, model, ttl=PERKS_CATALOG_TTL):
+        self.model = model
+        self.ttl = ttl
+        self.version = 0
+        self._perks = None
+        self._by_id = None
+        self._expires = 0
+
+    def invalidate(self):
+        self.version += 1
+        self._expires = 0
+
+    def _detached(self, row):
+        perk = self.model(**row._asdict())
+        make_transient_to_detached(perk)
+        return perk
+
+    def _load(self):
+        columns = [getattr(self.model, a.key)
+                   for a in inspect(self.model).column_attrs]
+        perks = [self._detached(row)
+                 for row in (Base.session.query(*columns).
+                             autoflush(False).
+                             order_by(self.model.created.desc()))]
+        self._by_id = dict((p.id, p) for p in perks)
+        self._perks = perks
+        self._expires = time.time() + self.ttl
+
+    def perks(self):
+        """Returns all the perks, deleted ones included, newest first."""
+        if time.time() >= self._expires:
+            self._load()
+        return self._perks
+
+    def get(self, id):
+        self.perks()
+        perk = self._by_id.get(id)
+        if perk is None:
+            # Added by another process since the last load
+            self._load()
+            perk = self._by_id.get(id)
+        return perk
+
+    def with_names(self, *names):
+        return [p for p in self.perks()
+                if not p.deleted and p.name in names]
+
+    def without_name(self, name):
+        return [p for p in self.perks()
+                if not p.deleted and p.name != name]
+
+    def resolve(self, user_perks):
+        """Sets the ``perk`` of each of the given user perks, loaded with
+        ``perk_id`` only, out of the catalog."""
+        for p in user_perks:
+            set_committed_value(p, 'perk', self.get(p.perk_id))
+        return user_perks
+
+
+DRIVER_PERKS = PerksCatalog(DriverPerk)
+PASSENGER_PERKS = PerksCatalog(PassengerPerk)
+
+
+def _perk_written(catalog):
+    def listener(mapper, connection, target):
+        session = object_session(target)
+        session.info.setdefault('perks_catalogs', set()).add(catalog)
+    return listener
+
+
+for (model, catalog) in ((DriverPerk, DRIVER_PERKS),
+                         (PassengerPerk, PASSENGER_PERKS)):
+    for identifier in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, identifier, _perk_written(catalog))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_perks_catalogs(session):
+    # Invalidating before the commit would let a concurrent read cache the
+    # table without the new perks
+    for catalog in session.info.pop('perks_catalogs', ()):
+        catalog.invalidate()
+
+
+def _perk_id_in(column, perks):
+    ids = [p.id for p in perks]
+    return column.in_(ids) if ids else false()
+
 
 class PerksRepository(object):
     STANDARD_DRIVER_NAME = 'driver_standard'
@@ -34,29 +156,30 @@ class PerksRepository(object):
     EARLY_BIRD_DRIVER_NAME = 'driver_early_bird'
 
     @staticmethod
-    def _all_driver_perks(limit, offset):
+    def _driver_perks():
         return (DriverPerk.query.
                 filter(DriverPerk.deleted == false()).
                 filter(DriverPerk.name
-                       != PerksRepository.STANDARD_DRIVER_NAME).
-                order_by(DriverPerk.created.desc()).
-                limit(limit).
-                offset(offset))
+                       != PerksRepository.STANDARD_DRIVER_NAME))
 
     @staticmethod
     def all_driver_perks(limit, offset):
-        return [expunged(r, DriverPerk.session)
-                for r in PerksRepository._all_driver_perks(limit, offset)]
+        perks = DRIVER_PERKS.without_name(PerksRepository.STANDARD_DRIVER_NAME)
+        return perks[offset:offset + limit]
+
+    @staticmethod
+    def all_driver_perks_page(limit, token):
+        return paginate(PerksRepository._driver_perks(), DriverPerk,
+                        limit, token, descending=True)
 
     @staticmethod
     def _eligible_driver_perks_with_name(name):
         return (Base.session.query(EligibleDriverPerk).
                 options(joinedload_all('user')).
-                options(joinedload_all('perk')).
-                join('perk').
                 join('user').
                 filter(EligibleDriverPerk.deleted == false()).
-                filter(DriverPerk.name == name).
+                filter(_perk_id_in(EligibleDriverPerk.perk_id,
+                                   DRIVER_PERKS.with_names(name))).
                 filter(~exists().
                        where(and_(ActiveDriverPerk.perk_id ==
                                   EligibleDriverPerk.perk_id,
@@ -67,38 +190,36 @@ class PerksRepository(object):
 
     @staticmethod
     def eligible_driver_perks_with_name(name):
-        return [expunged(p, Base.session)
-                for p in PerksRepository.
-                _eligible_driver_perks_with_name(name)]
+        return DRIVER_PERKS.resolve([expunged(p, Base.session)
+                                     for p in PerksRepository.
+                                     _eligible_driver_perks_with_name(name)])
 
     @staticmethod
     def _active_driver_perks_with_name(name):
         return (Base.session.query(ActiveDriverPerk).
                 options(joinedload_all('user')).
-                options(joinedload_all('perk')).
-                join('perk').
                 join('user').
                 filter(ActiveDriverPerk.deleted == false()).
-                filter(DriverPerk.name == name).
+                filter(_perk_id_in(ActiveDriverPerk.perk_id,
+                                   DRIVER_PERKS.with_names(name))).
                 order_by(ActiveDriverPerk.created.desc()).
                 group_by(User.id, ActiveDriverPerk.id))
 
     @staticmethod
     def active_driver_perks_with_name(name):
-        return [expunged(p, Base.session)
-                for p in PerksRepository.
-                _active_driver_perks_with_name(name)]
+        return DRIVER_PERKS.resolve([expunged(p, Base.session)
+                                     for p in PerksRepository.
+                                     _active_driver_perks_with_name(name)])
 
     @staticmethod
     def _eligible_driver_perk_with_name_and_user_id(name, user_id):
         return (Base.session.query(EligibleDriverPerk).
-                options(joinedload_all('perk')).
                 options(joinedload_all('user')).
-                join('perk').
                 join('user').
                 filter(EligibleDriverPerk.deleted == false()).
                 filter(EligibleDriverPerk.user_id == user_id).
-                filter(DriverPerk.name == name).
+                filter(_perk_id_in(EligibleDriverPerk.perk_id,
+                                   DRIVER_PERKS.with_names(name))).
                 filter(~exists().
                        where(and_(ActiveDriverPerk.perk_id ==
                                   EligibleDriverPerk.perk_id,
@@ -107,46 +228,36 @@ class PerksRepository(object):
 
     @staticmethod
     def eligible_driver_perk_with_name_and_user_id(name, user_id):
-        return [expunged(r, EligibleDriverPerk.session)
-                for r in PerksRepository.
-                _eligible_driver_perk_with_name_and_user_id(name, user_id)]
+        return DRIVER_PERKS.resolve(
+            [expunged(r, EligibleDriverPerk.session)
+             for r in PerksRepository.
+             _eligible_driver_perk_with_name_and_user_id(name, user_id)])
 
     @staticmethod
-    def _all_passenger_perks(limit, offset):
+    def _passenger_perks():
         return (PassengerPerk.query.
                 filter(PassengerPerk.deleted == false()).
                 filter(PassengerPerk.name
-                       != PerksRepository.STANDARD_PASSENGER_NAME).
-                order_by(PassengerPerk.created.desc()).
-                limit(limit).
-                offset(offset))
+                       != PerksRepository.STANDARD_PASSENGER_NAME))
 
     @staticmethod
     def all_passenger_perks(limit, offset):
-        return [expunged(r, PassengerPerk.session)
-                for r in PerksRepository._all_passenger_perks(limit, offset)]
+        perks = PASSENGER_PERKS.without_name(PerksRepository.
+                                             STANDARD_PASSENGER_NAME)
+        return perks[offset:offset + limit]
 
     @staticmethod
-    def _driver_perks_with_names(*names):
-        return (DriverPerk.query.
-                filter(DriverPerk.deleted == false()).
-                filter(DriverPerk.name.in_(names)))
+    def all_passenger_perks_page(limit, token):
+        return paginate(PerksRepository._passenger_perks(), PassengerPerk,
+                        limit, token, descending=True)
 
     @staticmethod
     def driver_perks_with_names(*names):
-        return [expunged(p, Base.session)
-                for p in PerksRepository._driver_perks_with_names(*names)]
-
-    @staticmethod
-    def _passenger_perks_with_names(*names):
-        return (PassengerPerk.query.
-                filter(PassengerPerk.deleted == false()).
-                filter(PassengerPerk.name.in_(names)))
+        return DRIVER_PERKS.with_names(*names)
 
     @staticmethod
     def passenger_perks_with_names(*names):
-        return [expunged(p, Base.session)
-                for p in PerksRepository._passenger_perks_with_names(*names)]
+        return PASSENGER_PERKS.with_names(*names)
 
     @staticmethod
     def add_driver_perk(name, eligible_for, active_for, fixed_rate,
@@ -192,7 +303,7 @@ class PerksRepository(object):
 
     @staticmethod
     def _eligible_driver_perks(user_id):
-        return (EligibleDriverPerk.query.options(joinedload('perk')).
+        return (EligibleDriverPerk.query.
                 filter(EligibleDriverPerk.deleted == false()).
                 filter(EligibleDriverPerk.user_id == user_id).
                 filter(EligibleDriverPerk.valid_until >= date.today()).
@@ -205,12 +316,13 @@ class PerksRepository(object):
 
     @staticmethod
     def eligible_driver_perks(user_id):
-        return [expunged(p, Base.session)
-                for p in PerksRepository._eligible_driver_perks(user_id)]
+        return DRIVER_PERKS.resolve([expunged(p, Base.session)
+                                   for p in PerksRepository.
+                                   _eligible_driver_perks(user_id)])
 
     @staticmethod
     def _eligible_passenger_perks(user_id):
-        return (EligiblePassengerPerk.query.options(joinedload('perk')).
+        return (EligiblePassengerPerk.query.
                 filter(EligiblePassengerPerk.deleted == false()).
                 filter(EligiblePassengerPerk.user_id == user_id).
                 filter(EligiblePassengerPerk.valid_until >= date.today()).
@@ -223,8 +335,27 @@ class PerksRepository(object):
 
     @staticmethod
     def eligible_passenger_perks(user_id):
-        return [expunged(p, Base.session)
-                for p in PerksRepository._eligible_passenger_perks(user_id)]
+        return PASSENGER_PERKS.resolve([expunged(p, Base.session)
+                                      for p in PerksRepository.
+                                      _eligible_passenger_perks(user_id)])
+
+    @staticmethod
+    def run_driver_perk_campaign_chunk(campaign, perk_name, decide,
+                                       chunk_size=1000):
+        return run_campaign_chunk(DRIVER_PERKS, EligibleDriverPerk,
+                                  ActiveDriverPerk, campaign, perk_name,
+                                  decide, chunk_size)
+
+    @staticmethod
+    def run_passenger_perk_campaign_chunk(campaign, perk_name, decide,
+                                          chunk_size=1000):
+        return run_campaign_chunk(PASSENGER_PERKS, EligiblePassengerPerk,
+                                  ActivePassengerPerk, campaign, perk_name,
+                                  decide, chunk_size)
+
+    @staticmethod
+    def sweep_expired_perks(expired_before, chunk_size=1000):
+        return sweep_expired_perks(expired_before, chunk_size)
 
     @staticmethod
     def activate_driver_perk(user, perk):
@@ -246,7 +377,7 @@ class PerksRepository(object):
 
     @staticmethod
     def _active_driver_perks(user_id):
-        return (ActiveDriverPerk.query.options(joinedload('perk')).
+        return (ActiveDriverPerk.query.
                 filter(ActiveDriverPerk.deleted == false()).
                 filter(ActiveDriverPerk.user_id == user_id).
                 filter(ActiveDriverPerk.valid_until >= date.today()).
@@ -254,8 +385,9 @@ class PerksRepository(object):
 
     @staticmethod
     def active_driver_perks(user_id):
-        return [expunged(p, Base.session)
-                for p in PerksRepository._active_driver_perks(user_id)]
+        return DRIVER_PERKS.resolve([expunged(p, Base.session)
+                                   for p in PerksRepository.
+                                   _active_driver_perks(user_id)])
 
     @staticmethod
     def active_driver_perks_without_standard_one(user_id):
@@ -264,7 +396,7 @@ class PerksRepository(object):
 
     @staticmethod
     def _active_passenger_perks(user_id):
-        return (ActivePassengerPerk.query.options(joinedload('perk')).
+        return (ActivePassengerPerk.query.
                 filter(ActivePassengerPerk.deleted == false()).
                 filter(ActivePassengerPerk.user_id == user_id).
                 filter(ActivePassengerPerk.valid_until >= date.today()).
@@ -272,10 +404,97 @@ class PerksRepository(object):
 
     @staticmethod
     def active_passenger_perks(user_id):
-        return [expunged(p, Base.session)
-                for p in PerksRepository._active_passenger_perks(user_id)]
+        return PASSENGER_PERKS.resolve([expunged(p, Base.session)
+                                      for p in PerksRepository.
+                                      _active_passenger_perks(user_id)])
 
     @staticmethod
     def active_passenger_perks_without_standard_one(user_id):
         return (p for p in PerksRepository.active_passenger_perks(user_id)
                 if p.perk.name != PerksRepository.STANDARD_PASSENGER_NAME)
+
+
+def _campaign_eligible(eligible, active, perks):
+    return (eligible.query.
+            filter(eligible.deleted == false()).
+            filter(_perk_id_in(eligible.perk_id, perks)).
+            filter(~exists().
+                   where(and_(active.perk_id == eligible.perk_id,
+                              active.user_id == eligible.user_id))))
+
+
+def _campaign_checkpoint(campaign):
+    checkpoint = PerkCampaignCheckpoint.query.get(campaign)
+    if checkpoint is None:
+        checkpoint = PerkCampaignCheckpoint(campaign=campaign, token=None,
+                                            completed=False, activated=0)
+        Base.session.add(checkpoint)
+    return checkpoint
+
+
+def run_campaign_chunk(catalog, eligible, active, campaign, perk_name,
+                       decide, chunk_size):
+    """Runs the next chunk of the activation campaign ``campaign``.
+
+    Walks, ``chunk_size`` at a time and in (created, id) order, the
+    ``eligible`` perks named ``perk_name`` which have not been activated
+    yet;  ``decide`` is given the chunk, and returns the eligible perks to
+    activate, which are then bulk-inserted into the ``active`` table.
+
+    The position of the campaign is saved in its ``PerkCampaignCheckpoint``,
+    so the chunk and the checkpoint should be committed together:  a
+    campaign interrupted midway will then resume right after the last
+    committed chunk.  Returns a ``CampaignChunk``."""
+    checkpoint = _campaign_checkpoint(campaign)
+    if checkpoint.completed:
+        return CampaignChunk(campaign, 0, 0, True)
+    perks = catalog.with_names(perk_name)
+    page = paginate(_campaign_eligible(eligible, active, perks), eligible,
+                    chunk_size, checkpoint.token)
+    activated = decide(page.items) if page.items else []
+    if activated:
+        today = date.today()
+        active_for = dict((p.id, p.active_for) for p in perks)
+        Base.session.execute(active.__table__.insert(),
+                             [dict(id=unicode(uuid.uuid4()),
+                                   deleted=False,
+                                   user_id=p.user_id,
+                                   perk_id=p.perk_id,
+                                   valid_until=today +
+                                   timedelta(active_for[p.perk_id]))
+                              for p in activated])
+    checkpoint.token = page.token
+    checkpoint.completed = page.token is None
+    checkpoint.activated += len(activated)
+    return CampaignChunk(campaign, len(page.items), len(activated),
+                         checkpoint.completed)
+
+
+def _sweep_expired(model, expired_before, chunk_size):
+    expired = and_(model.deleted == false(),
+                   model.valid_until < expired_before)
+    swept = 0
+    while True:
+        ids = [id for (id,) in (Base.session.query(model.id).
+                                filter(expired).
+                                limit(chunk_size))]
+        if not ids:
+            return swept
+        swept += (Base.session.query(model).
+                  filter(model.id.in_(ids)).
+                  filter(expired).
+                  update({model.deleted: True}, synchronize_session=False))
+
+
+def sweep_expired_perks(expired_before, chunk_size):
+    """Soft-deletes, ``chunk_size`` rows per UPDATE statement, the eligible
+    and active perks which expired before ``expired_before``;  returns the
+    ``SweptPerks`` counts.
+
+    Eligible perks are still looked at by activation campaigns once they
+    expire (e.g. the early-bird one), so ``expired_before`` should leave
+    them enough time to run."""
+    return SweptPerks(*[_sweep_expired(model, expired_before, chunk_size)
+                        for model in (EligibleDriverPerk, ActiveDriverPerk,
+                                      EligiblePassengerPerk,
+                                      ActivePassengerPerk)])
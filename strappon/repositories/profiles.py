@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+from strappon.models import Base
+from strappon.repositories.drive_requests import _distance_driver
+from strappon.repositories.drive_requests import _distance_passenger
+from strappon.repositories.drive_requests import _rides_driver
+from strappon.repositories.drive_requests import _rides_passenger
+from strappon.repositories.payments import _signed_credits_sum
+from strappon.repositories.rates import _received_rates
+from strappon.repositories.rates import _stars_sum
+
+
+ProfileStats = namedtuple('ProfileStats',
+                          'stars received_rates '
+                          'rides_driver rides_passenger '
+                          'distance_driver distance_passenger '
+                          'balance bonus_balance'.split())
+
+
+class ProfilesRepository(object):
+    @staticmethod
+    def stats(user_id):
+        return stats(user_id)
+
+
+def _stats(user_id):
+    columns = [(_stars_sum(user_id), 'stars_sum'),
+               (_received_rates(user_id), 'received_rates'),
+               (_rides_driver(user_id), 'rides_driver'),
+               (_rides_passenger(user_id), 'rides_passenger'),
+               (_distance_driver(user_id), 'distance_driver'),
+               (_distance_passenger(user_id), 'distance_passenger'),
+               (_signed_credits_sum(user_id, False), 'balance'),
+               (_signed_credits_sum(user_id, True), 'bonus_balance')]
+    return Base.session.query(*[query.as_scalar().label(name)
+                                for (query, name) in columns])
+
+
+def stats(user_id):
+    """Returns the ``ProfileStats`` of the given user, i.e. the ratings,
+    rides, distances and balances shown on the private profile, all of them
+    computed by a single statement."""
+    (stars_sum, received_rates, rides_driver, rides_passenger,
+     distance_driver, distance_passenger,
+     balance, bonus_balance) = _stats(user_id).one()
+    received_rates = received_rates or 0
+    stars = stars_sum / float(received_rates) if received_rates else 0.0
+    return ProfileStats(stars, received_rates,
+                        rides_driver or 0, rides_passenger or 0,
+                        distance_driver or 0.0, distance_passenger or 0.0,
+                        float(balance or 0), float(bonus_balance or 0))
@@ -2,12 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import uuid
+from collections import namedtuple
 
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
 from strappon.models import Base
+from strappon.models import PendingRating
 from strappon.models import Rate
+from strappon.models import UserRatingSummary
+from weblib.db import exists
 from weblib.db import func
 
 
+STARS = range(1, 6)
+
+
+RatingStats = namedtuple('RatingStats', 'avg_stars received_rates'.split())
+
+
 class RatesRepository(object):
     @staticmethod
     def add(drive_request_id, rater_user_id, rated_user_id, rater_is_driver,
@@ -19,15 +31,178 @@ class RatesRepository(object):
                     rated_user_id=rated_user_id,
                     rater_is_driver=rater_is_driver,
                     stars=stars)
+        add_to_summary(rated_user_id, stars)
+        (Base.session.query(PendingRating).
+         filter(PendingRating.drive_request_id == drive_request_id).
+         filter(PendingRating.user_id == rater_user_id).
+         delete(synchronize_session=False))
         return rate
 
     @staticmethod
     def avg_stars(rated_user_id):
-        avg = Base.session.query(func.avg(Rate.stars)).\
-                filter(Rate.rated_user_id == rated_user_id).first()[0]
-        return 0.0 if avg is None else avg
+        summary = UserRatingSummary.query.get(rated_user_id)
+        if summary is None or summary.received_rates == 0:
+            return 0.0
+        return summary.stars_sum / float(summary.received_rates)
 
     @staticmethod
     def received_rates(rated_user_id):
-        return Base.session.query(func.count()).\
-                filter(Rate.rated_user_id == rated_user_id).first()[0]
+        summary = UserRatingSummary.query.get(rated_user_id)
+        return 0 if summary is None else summary.received_rates
+
+    @staticmethod
+    def stats_for_users(rated_user_ids):
+        return stats_for_users(rated_user_ids)
+
+    @staticmethod
+    def rebuild_summaries(chunk_size=1000):
+        return rebuild_summaries(chunk_size)
+
+    @staticmethod
+    def check_summaries(chunk_size=1000):
+        return check_summaries(chunk_size)
+
+
+def _stars_column(stars):
+    return getattr(UserRatingSummary, 'stars_%d' % stars, None)
+
+
+def add_to_summary(rated_user_id, stars):
+    """Adds a rate of ``stars`` to the summary of the rated user, creating
+    the summary if this is the first rate the user receives."""
+    values = {UserRatingSummary.stars_sum: UserRatingSummary.stars_sum + stars,
+              UserRatingSummary.received_rates:
+              UserRatingSummary.received_rates + 1}
+    column = _stars_column(stars)
+    if column is not None:
+        values[column] = column + 1
+    query = (Base.session.query(UserRatingSummary).
+             filter(UserRatingSummary.user_id == rated_user_id))
+    if not query.update(values, synchronize_session='evaluate'):
+        _add_empty_summary(rated_user_id)
+        query.update(values, synchronize_session='evaluate')
+
+
+def _add_empty_summary(rated_user_id):
+    """Inserts an empty summary for ``rated_user_id``, unless a concurrent
+    transaction already did (e.g. for another first rate of the user)."""
+    try:
+        with Base.session.begin_nested():
+            Base.session.execute(UserRatingSummary.__table__.insert(),
+                                 dict(user_id=rated_user_id))
+    except IntegrityError:
+        pass
+
+
+def stats_for_users(rated_user_ids):
+    """Returns a dictionary mapping each of the given user IDs to its
+    ``RatingStats``, reading all the summaries with a single query."""
+    rated_user_ids = set(rated_user_ids)
+    stats = dict((user_id, RatingStats(0.0, 0)) for user_id in rated_user_ids)
+    if not rated_user_ids:
+        return stats
+    query = (Base.session.query(UserRatingSummary.user_id,
+                                UserRatingSummary.stars_sum,
+                                UserRatingSummary.received_rates).
+             filter(UserRatingSummary.user_id.in_(rated_user_ids)))
+    for (user_id, stars_sum, received_rates) in query:
+        if received_rates:
+            stats[user_id] = RatingStats(stars_sum / float(received_rates),
+                                         received_rates)
+    return stats
+
+
+def _rated_user_ids(after, limit):
+    query = Base.session.query(Rate.rated_user_id)
+    if after is not None:
+        query = query.filter(Rate.rated_user_id > after)
+    return [user_id
+            for (user_id,) in (query.
+                               group_by(Rate.rated_user_id).
+                               order_by(Rate.rated_user_id).
+                               limit(limit))]
+
+
+def _summaries_from_rates(user_ids):
+    columns = [func.sum(case([(Rate.stars == s, 1)], else_=0))
+               for s in STARS]
+    query = (Base.session.query(Rate.rated_user_id,
+                                func.sum(Rate.stars),
+                                func.count(),
+                                *columns).
+             filter(Rate.rated_user_id.in_(user_ids)).
+             group_by(Rate.rated_user_id))
+    return [dict(user_id=row[0], stars_sum=int(row[1]),
+                 received_rates=int(row[2]),
+                 **dict(('stars_%d' % s, int(n))
+                        for (s, n) in zip(STARS, row[3:])))
+            for row in query]
+
+
+def _chunks(chunk_size):
+    after = None
+    while True:
+        user_ids = _rated_user_ids(after, chunk_size)
+        if not user_ids:
+            return
+        yield user_ids
+        after = user_ids[-1]
+
+
+def rebuild_summaries(chunk_size):
+    """Recomputes the rating summaries out of the ``rate`` table,
+    ``chunk_size`` rated users at a time;  returns the number of summaries
+    written."""
+    table = UserRatingSummary.__table__
+    Base.session.execute(table.delete().
+                         where(~exists().
+                               where(Rate.rated_user_id == table.c.user_id)))
+    rebuilt = 0
+    for user_ids in _chunks(chunk_size):
+        summaries = _summaries_from_rates(user_ids)
+        Base.session.execute(table.delete().
+                             where(table.c.user_id.in_(user_ids)))
+        Base.session.execute(table.insert(), summaries)
+        rebuilt += len(summaries)
+    return rebuilt
+
+
+def _summary_values(summary):
+    return dict(user_id=summary.user_id, stars_sum=summary.stars_sum,
+                received_rates=summary.received_rates,
+                **dict(('stars_%d' % s, getattr(summary, 'stars_%d' % s))
+                       for s in STARS))
+
+
+def check_summaries(chunk_size):
+    """Compares the rating summaries with the ones computed out of the
+    ``rate`` table;  returns the IDs of the users whose summary is missing,
+    stale or should not exist at all."""
+    mismatching = []
+    for user_ids in _chunks(chunk_size):
+        expected = dict((s['user_id'], s)
+                        for s in _summaries_from_rates(user_ids))
+        actual = dict((s.user_id, _summary_values(s))
+                      for s in (UserRatingSummary.query.
+                                filter(UserRatingSummary.user_id.
+                                       in_(user_ids))))
+        mismatching.extend(user_id for user_id in user_ids
+                           if expected[user_id] != actual.get(user_id))
+    orphans = (Base.session.query(UserRatingSummary.user_id).
+               filter(~exists().
+                      where(Rate.rated_user_id == UserRatingSummary.user_id)))
+    mismatching.extend(user_id for (user_id,) in orphans)
+    return mismatching
+
+
+def _summary_column(rated_user_id, column):
+    return (Base.session.query(column).
+            filter(UserRatingSummary.user_id == rated_user_id))
+
+
+def _stars_sum(rated_user_id):
+    return _summary_column(rated_user_id, UserRatingSummary.stars_sum)
+
+
+def _received_rates(rated_user_id):
+    return _summary_column(rated_user_id, UserRatingSummary.received_rates)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests run against an in-memory SQLite database:  from the root of the
+repository, ``python -m unittest discover``."""
+
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import DefaultClause
+
+from strappon.models import Base
+from strappon.models import Driver
+from strappon.models import Passenger
+from strappon.models import User
+from strappon.repositories.perks import DRIVER_PERKS
+from strappon.repositories.perks import PASSENGER_PERKS
+from weblib.db import text
+
+
+def _sqlite_server_defaults():
+    # text('') renders as an empty DEFAULT clause, which SQLite rejects
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            default = column.server_default
+            if default is not None and str(default.arg) == '':
+                column.server_default = DefaultClause(text("''"))
+
+
+def setup_database(savepoints=True, path=None):
+    """Binds the session to a new in-memory database, shared by all the
+    threads, and creates the tables;  returns the list the text of each
+    executed statement is appended to.
+
+    pysqlite does not begin transactions until the first DML statement,
+    breaking SAVEPOINT;  with ``savepoints`` set, transactions are begun
+    explicitly instead, hence a single session at a time can use the
+    database.
+
+    If ``path`` is given, the database is stored there instead, and each
+    thread gets its own connection, waiting for the others' locks."""
+    if path is None:
+        engine = create_engine('sqlite://', poolclass=StaticPool,
+                               connect_args=dict(check_same_thread=False))
+    else:
+        engine = create_engine('sqlite:///' + path,
+                               connect_args=dict(timeout=30))
+    statements = []
+
+    if savepoints:
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def begin(conn):
+            conn.execute('BEGIN')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    Base.session.remove()
+    Base.session.configure(bind=engine)
+    _sqlite_server_defaults()
+    Base.metadata.create_all(engine)
+    return statements
+
+
+class DatabaseTestCase(unittest.TestCase):
+    savepoints = True
+    path = None
+
+    def setUp(self):
+        self.statements = setup_database(self.savepoints, self.path)
+        self.session = Base.session
+        DRIVER_PERKS.invalidate()
+        PASSENGER_PERKS.invalidate()
+
+    def tearDown(self):
+        self.session.remove()
+
+    def add_user(self, id, **kw):
+        user = User(id=id, name=u'name', locale=u'en', **kw)
+        self.session.add(user)
+        return user
+
+    def add_driver(self, id, user_id):
+        driver = Driver(id=id, user_id=user_id, hidden=False, active=True)
+        self.session.add(driver)
+        return driver
+
+    def add_passenger(self, id, user_id, distance=1.0, **kw):
+        passenger = Passenger(id=id, user_id=user_id, distance=distance,
+                              seats=1, matched=False, active=True, **kw)
+        self.session.add(passenger)
+        return passenger
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+
+from sqlalchemy import event
+from strappon.models import DriveRequest
+from strappon.models import UserRideStats
+from strappon.pubsub.drive_requests import CancelledRidesRemover
+from strappon.pubsub.drive_requests import DriveRequestCancellor
+from strappon.pubsub.drive_requests import MultipleDriveRequestsCancellor
+from strappon.repositories.drive_requests import DriveRequestsRepository
+from strappon.repositories.profiles import ProfilesRepository
+from tests import DatabaseTestCase
+
+
+class RidesTestCase(DatabaseTestCase):
+    PASSENGERS = 2
+
+    def setUp(self):
+        super(RidesTestCase, self).setUp()
+        self.add_user(u'driver')
+        self.add_driver(u'd', u'driver')
+        for i in xrange(self.PASSENGERS):
+            self.add_user(u'passenger%d' % i)
+            self.add_passenger(u'p%d' % i, u'passenger%d' % i, distance=10.0)
+            self.session.add(DriveRequestsRepository.add(u'd', u'p%d' % i,
+                                                         None))
+        self.session.commit()
+
+    def accepted(self):
+        requests = []
+        for i in xrange(self.PASSENGERS):
+            requests.append(DriveRequestsRepository.accept(u'd', u'p%d' % i))
+        self.session.commit()
+        return requests
+
+    def rides_driver(self):
+        return ProfilesRepository.stats(u'driver').rides_driver
+
+    def perform(self, publisher, *args):
+        published = []
+        publisher.publish = lambda *message: published.append(message)
+        publisher.perform(*args)
+        self.session.commit()
+        return published
+
+
+class CancellorsTest(RidesTestCase):
+    def assertCancelled(self, requests):
+        self.assertEqual([(False, True)] * len(requests),
+                         [(r.active, r.cancelled) for r in requests])
+        self.assertEqual(len(requests),
+                         self.session.query(DriveRequest).
+                         filter_by(active=False, cancelled=True).count())
+
+    def test_cancellor_with_repository_removes_rides(self):
+        requests = self.accepted()
+        self.assertEqual(2, self.rides_driver())
+
+        self.perform(DriveRequestCancellor(), requests[0],
+                     DriveRequestsRepository)
+
+        self.assertEqual(1, self.rides_driver())
+        self.perform(MultipleDriveRequestsCancellor(), requests,
+                     DriveRequestsRepository)
+
+        self.assertEqual(0, self.rides_driver())
+        self.assertCancelled(requests)
+
+    def test_cancellors_chained_with_rides_remover(self):
+        requests = self.accepted()
+
+        published = self.perform(MultipleDriveRequestsCancellor(), requests)
+        self.assertEqual(2, self.rides_driver())
+        self.perform(CancelledRidesRemover(), DriveRequestsRepository,
+                     published[0][1])
+
+        self.assertEqual(0, self.rides_driver())
+        self.assertEqual([('drive_request_cancelled', requests[0])],
+                         self.perform(DriveRequestCancellor(), requests[0]))
+
+
+class CancelAllTest(RidesTestCase):
+    def test_rows_skipped_by_the_update_are_not_returned(self):
+        requests = self.accepted()
+        engine = self.session.bind
+
+        # Deactivate the first request between the SELECT and the UPDATE,
+        # as a concurrent transaction could on databases without locking
+        @event.listens_for(engine, 'before_cursor_execute')
+        def deactivate(conn, cursor, statement, parameters, context,
+                       executemany):
+            if statement.startswith('UPDATE drive_request'):
+                event.remove(engine, 'before_cursor_execute', deactivate)
+                cursor.connection.execute('UPDATE drive_request '
+                                          'SET active = 0 WHERE id = ?',
+                                          (requests[0].id,))
+
+        cancelled = DriveRequestsRepository.cancel_all([r.id
+                                                        for r in requests])
+        self.session.commit()
+
+        self.assertEqual([requests[1].id], cancelled)
+        self.assertEqual(1, self.rides_driver())
+
+
+class ConcurrentAcceptTest(RidesTestCase):
+    PASSENGERS = 1
+    THREADS = 8
+
+    # Each thread needs its own connection, hence a database file;  the ride
+    # stats are created upfront, so that no SAVEPOINT is needed
+    savepoints = False
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        super(ConcurrentAcceptTest, self).setUp()
+        self.session.add_all([UserRideStats(user_id=u'driver'),
+                              UserRideStats(user_id=u'passenger0')])
+        self.session.commit()
+
+    def tearDown(self):
+        super(ConcurrentAcceptTest, self).tearDown()
+        self.session.bind.dispose()
+        os.remove(self.path)
+
+    def test_exactly_one_accept_wins(self):
+        selected = threading.Semaphore(0)
+        go = threading.Event()
+        results = []
+
+        # Let every thread select the request before any of them updates it
+        @event.listens_for(self.session.bind, 'before_cursor_execute')
+        def wait(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE drive_request'):
+                selected.release()
+                go.wait(30)
+
+        def accept():
+            try:
+                results.append(DriveRequestsRepository.accept(u'd', u'p0'))
+                self.session.commit()
+            except Exception as e:
+                results.append(e)
+                self.session.rollback()
+            finally:
+                self.session.remove()
+
+        threads = [threading.Thread(target=accept)
+                   for _ in xrange(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for _ in threads:
+            selected.acquire()
+        go.set()
+        for thread in threads:
+            thread.join()
+
+        winners = [r for r in results if r is not None]
+        self.assertEqual(self.THREADS, len(results))
+        self.assertEqual(1, len(winners))
+        self.assertTrue(winners[0].accepted)
+        self.assertEqual(1, self.rides_driver())
+        self.assertEqual(1, ProfilesRepository.stats(u'passenger0').
+                         rides_passenger)
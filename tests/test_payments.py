@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+import unittest
+from math import pi
+
+from strappon.models import Payment
+from strappon.pubsub.payments import fare_for
+from strappon.pubsub.payments import fares_for
+from strappon.pubsub.payments import reimbursement_for
+from strappon.pubsub.payments import reimbursements_for
+from strappon.repositories.payments import PaymentsRepository
+from strappon.repositories.payments import Settlement
+from tests import DatabaseTestCase
+
+
+def _next_float(x, steps):
+    bits = struct.unpack('<q', struct.pack('<d', x))[0]
+    return struct.unpack('<d', struct.pack('<q', bits + steps))[0]
+
+
+class PricesForTest(unittest.TestCase):
+    def setUp(self):
+        boundary = pi / 1.5
+        self.assertEqual(pi, boundary * 1.5)
+        distances = [0.0, 1.0, 10.0] + [_next_float(boundary, steps)
+                                        for steps in (-2, -1, 0, 1, 2)]
+        self.seats = [s for s in (1, 2, 3) for _ in distances]
+        self.distances = distances * 3
+
+    def test_reimbursements_same_as_scalar(self):
+        self.assertEqual([reimbursement_for(0.0, 1.0, s, d)
+                          for (s, d) in zip(self.seats, self.distances)],
+                         reimbursements_for(0.0, 1.0, self.seats,
+                                            self.distances))
+
+    def test_fares_same_as_scalar(self):
+        self.assertEqual([fare_for(0.0, 1.0, s, d)
+                          for (s, d) in zip(self.seats, self.distances)],
+                         fares_for(0.0, 1.0, self.seats, self.distances))
+
+    def test_boundary_is_a_short_ride(self):
+        self.assertEqual([1.5, 3], fares_for(0.0, 1.0, [1, 2],
+                                             [pi / 1.5, pi / 1.5]))
+        self.assertEqual([2.5, 5], fares_for(0.0, 1.0, [1, 2],
+                                             [_next_float(pi / 1.5, 1)] * 2))
+
+
+class AddManyTest(DatabaseTestCase):
+    def test_same_payments_as_fare_creator(self):
+        PaymentsRepository.add_many([Settlement(u'r0', u'u0', None, 3, None),
+                                     Settlement(u'r1', u'u0', None, 2,
+                                                u'promo')], 1)
+
+        payments = self.session.query(Payment).order_by(
+            Payment.drive_request_id)
+        self.assertEqual([(3, 0, None), (0, 2, u'promo')],
+                         [(p.credits, p.bonus_credits, p.promo_code_id)
+                          for p in payments])
+        self.assertEqual([(-3.0, None), (-2.0, u'promo')],
+                         sorted(PaymentsRepository.detailed_balance(u'u0')))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import inspect
+from strappon.models import DriverPerk
+from strappon.repositories.perks import DRIVER_PERKS
+from tests import DatabaseTestCase
+
+
+class PerksCatalogTest(DatabaseTestCase):
+    def setUp(self):
+        super(PerksCatalogTest, self).setUp()
+        self.session.add(DriverPerk(id=u'perk', name=u'driver_perk',
+                                    eligible_for=7, active_for=7,
+                                    fixed_rate=0.0, multiplier=1.0))
+        self.session.commit()
+
+    def test_caller_instances_stay_in_the_session(self):
+        perk = self.session.query(DriverPerk).get(u'perk')
+
+        cached = DRIVER_PERKS.get(u'perk')
+
+        self.assertIn(perk, self.session)
+        self.assertIsNot(perk, cached)
+        self.assertTrue(inspect(cached).detached)
+        self.assertEqual((u'perk', u'driver_perk', 7, 1.0),
+                         (cached.id, cached.name, cached.active_for,
+                          cached.multiplier))
+
+    def test_pending_changes_are_not_flushed(self):
+        perk = self.session.query(DriverPerk).get(u'perk')
+        perk.name = u'renamed'
+
+        self.assertEqual(u'driver_perk', DRIVER_PERKS.get(u'perk').name)
+        self.assertIn(perk, self.session.dirty)
+
+    def test_invalidated_on_commit(self):
+        self.assertEqual(u'driver_perk', DRIVER_PERKS.get(u'perk').name)
+        self.session.query(DriverPerk).get(u'perk').name = u'renamed'
+        self.session.commit()
+
+        self.assertEqual(u'renamed', DRIVER_PERKS.get(u'perk').name)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from datetime import tzinfo
+
+from strappon.pubsub import serialize_date
+
+
+class UTCPlusOne(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(hours=1)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+class SerializeDateTest(unittest.TestCase):
+    def assertSameAsStrftime(self, value):
+        self.assertEqual(value.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                         serialize_date(value))
+
+    def test_none(self):
+        self.assertIsNone(serialize_date(None))
+
+    def test_datetimes(self):
+        self.assertSameAsStrftime(datetime(2014, 1, 2, 3, 4, 5, 678))
+        self.assertSameAsStrftime(datetime(2014, 1, 2, 3, 4, 5))
+        self.assertSameAsStrftime(datetime(2014, 1, 2, 3, 4, 5, 678,
+                                           UTCPlusOne()))
+
+    def test_memoized_datetimes_differing_in_microseconds(self):
+        self.assertEqual([u'2014-01-02T03:04:05Z'] * 2,
+                         [serialize_date(datetime(2014, 1, 2, 3, 4, 5, 1)),
+                          serialize_date(datetime(2014, 1, 2, 3, 4, 5, 2))])
+
+    def test_dates(self):
+        self.assertSameAsStrftime(date(2014, 1, 2))
+
+    def test_times(self):
+        self.assertSameAsStrftime(time(3, 4, 5))
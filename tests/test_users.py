@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import date
+from datetime import timedelta
+
+from strappon.models import ActiveDriverPerk
+from strappon.models import DriveRequest
+from strappon.models import DriverPerk
+from strappon.models import EligibleDriverPerk
+from strappon.models import User
+from strappon.pubsub.users import enrich_private
+from strappon.pubsub.users import enrich_private_profile
+from strappon.repositories.drive_requests import DriveRequestsRepository
+from strappon.repositories.payments import PaymentsRepository
+from strappon.repositories.perks import PerksRepository
+from strappon.repositories.profiles import ProfilesRepository
+from strappon.repositories.rates import RatesRepository
+from tests import DatabaseTestCase
+
+
+DETAILS = ('stars received_rates rides_driver rides_passenger '
+           'distance_driver distance_passenger balance bonus_balance').split()
+
+
+class EnrichPrivateProfileTest(DatabaseTestCase):
+    def setUp(self):
+        super(EnrichPrivateProfileTest, self).setUp()
+        self.add_user(u'driver')
+        self.add_user(u'passenger')
+        self.add_driver(u'd', u'driver')
+        self.add_passenger(u'p', u'passenger', distance=12.5)
+        for i in xrange(3):
+            self.session.add(DriveRequest(id=u'r%d' % i, driver_id=u'd',
+                                          passenger_id=u'p',
+                                          accepted=False, active=True,
+                                          cancelled=False))
+        self.session.flush()
+        for i in xrange(3):
+            DriveRequestsRepository.accept(u'd', u'p')
+            self.session.add(RatesRepository.add(u'r%d' % i, u'passenger',
+                                                 u'driver', False, 3 + i))
+        self.session.add(PaymentsRepository.add(u'r0', u'passenger',
+                                                u'driver', 4, None, None))
+        valid_until = date.today() + timedelta(days=7)
+        self.session.add(DriverPerk(id=u'perk', name=u'driver_perk',
+                                    eligible_for=7, active_for=7,
+                                    fixed_rate=0.0, multiplier=1.0))
+        self.session.add(EligibleDriverPerk(user_id=u'driver',
+                                            perk_id=u'perk',
+                                            valid_until=valid_until))
+        self.session.add(ActiveDriverPerk(user_id=u'driver', perk_id=u'perk',
+                                          valid_until=valid_until))
+        self.session.commit()
+
+    def _enrich(self, enrich, *repositories):
+        user = self.session.query(User).get(u'driver')
+        self.session.expunge(user)
+        return enrich(*(repositories + (user,)))
+
+    def test_same_details_as_enrich_private(self):
+        expected = self._enrich(enrich_private, RatesRepository,
+                                DriveRequestsRepository, PerksRepository,
+                                PaymentsRepository)
+        actual = self._enrich(enrich_private_profile, ProfilesRepository,
+                              PerksRepository)
+
+        self.assertEqual([getattr(expected, d) for d in DETAILS],
+                         [getattr(actual, d) for d in DETAILS])
+        self.assertEqual((4.0, 3, 3, 0, 37.5, 0.0, 4.0, 0.0),
+                         tuple(getattr(actual, d) for d in DETAILS))
+        self.assertEqual([p.id for p in expected.eligible_driver_perks],
+                         [p.id for p in actual.eligible_driver_perks])
+        self.assertEqual([p.id for p in expected.active_driver_perks],
+                         [p.id for p in actual.active_driver_perks])
+
+    def test_bounded_number_of_statements(self):
+        self._enrich(enrich_private_profile, ProfilesRepository,
+                     PerksRepository)
+        del self.statements[:]
+
+        self._enrich(enrich_private_profile, ProfilesRepository,
+                     PerksRepository)
+
+        # The user itself, the stats and the four perk lists
+        self.assertEqual(6, len(self.statements))